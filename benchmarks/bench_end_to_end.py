@@ -0,0 +1,135 @@
+"""end-to-end throughput of a polling bot against the local fake Bot API
+
+run with: python benchmarks/bench_end_to_end.py [--chats 2000] [--rounds 2] [--engine sync|async]
+
+Every synthetic chat sends /echo once per round (every 4th chat presses a
+button instead) and the bot answers each update with one sendMessage. A round
+starts when the previous one is answered completely, teleasy ignores messages
+to chats whose handler is still running. The fake server runs in a child
+process, so thread count and peak RSS are the bot's own. Client-side rate
+limiting is off unless --rate-limit is given."""
+
+import argparse, importlib.util, multiprocessing, os, resource, sys, threading, time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+from fake_bot_api import FakeBotAPI, make_message_update, make_callback_update
+
+def load_teleasy():
+	spec = importlib.util.spec_from_file_location("teleasy", os.path.join(SRC, "__init__.py"), submodule_search_locations=[SRC])
+	teleasy = importlib.util.module_from_spec(spec)
+	sys.modules["teleasy"] = teleasy
+	spec.loader.exec_module(teleasy)
+	return teleasy
+
+def make_round(chats: int, round_number: int, callback_every: int) -> list:
+	updates = list()
+	for chat_id in range(1, chats + 1):
+		if callback_every and chat_id % callback_every == 0:
+			updates.append(make_callback_update(chat_id, f"button {round_number}"))
+		else:
+			updates.append(make_message_update(chat_id, f"/echo {round_number}"))
+	return updates
+
+def serve_fake_api(conn, chats: int, rounds: int, callback_every: int, timeout: float) -> None:
+	api = FakeBotAPI(record_calls=False)
+	conn.send(api.base_url)
+	script = [make_round(chats, round_number, callback_every) for round_number in range(rounds)]
+	# wait until the bot is polling
+	conn.recv()
+	started = time.perf_counter()
+	deadline = started + timeout
+	num_updates = 0
+	completed = True
+	for updates in script:
+		api.add_updates(updates)
+		num_updates += len(updates)
+		completed = api.wait_for_calls("sendMessage", num_updates, deadline - time.perf_counter())
+		if not completed:
+			break
+	elapsed = time.perf_counter() - started
+	conn.send({"completed": completed, "updates": num_updates, "elapsed": elapsed,
+		"latencies": api.latencies, "calls": dict(api.call_counts)})
+	api.close()
+
+def make_bot(teleasy, engine: str, base_url: str, args):
+	if engine == "async":
+		bot = teleasy.AsyncTelegramBot("BENCH", pool_size=args.pool_size, base_url=base_url)
+
+		@bot.on_command("echo")
+		async def echo(chat):
+			await chat.print("echo")
+
+		@bot.on_callback_query
+		async def pressed(chat):
+			await chat.print("pressed")
+	else:
+		bot = teleasy.TelegramBot("BENCH", pool_size=args.pool_size, base_url=base_url)
+		bot.config.set_worker_pool(max_workers=args.workers)
+		bot.config.set_batch_dispatch(routing_workers=args.routing_workers)
+
+		@bot.on_command("echo")
+		def echo(chat):
+			chat.print("echo")
+
+		@bot.on_callback_query
+		def pressed(chat):
+			chat.print("pressed")
+
+	bot.config.set_long_polling(timeout=1, limit=100)
+	if not args.rate_limit:
+		bot.api.rate_limiter = None
+	return bot
+
+def percentile(values: list, q: float) -> float:
+	values = sorted(values)
+	return values[int(q * (len(values) - 1))] if values else float("nan")
+
+def main() -> None:
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--chats", type=int, default=2000)
+	parser.add_argument("--rounds", type=int, default=2)
+	parser.add_argument("--callback-every", type=int, default=4)
+	parser.add_argument("--engine", choices=("sync", "async"), default="sync")
+	parser.add_argument("--workers", type=int, default=16)
+	parser.add_argument("--routing-workers", type=int, default=4)
+	parser.add_argument("--pool-size", type=int, default=10)
+	parser.add_argument("--rate-limit", action="store_true")
+	parser.add_argument("--timeout", type=float, default=300.0)
+	args = parser.parse_args()
+
+	conn, child_conn = multiprocessing.Pipe()
+	server = multiprocessing.Process(target=serve_fake_api,
+		args=(child_conn, args.chats, args.rounds, args.callback_every, args.timeout), daemon=True)
+	server.start()
+	base_url = conn.recv()
+
+	teleasy = load_teleasy()
+	bot = make_bot(teleasy, args.engine, base_url, args)
+	peak_threads = threading.active_count()
+	bot_thread = threading.Thread(target=bot.start, daemon=True)
+	bot_thread.start()
+	conn.send("start")
+
+	# the result arrives once every update has been answered
+	while not conn.poll(0.01):
+		peak_threads = max(peak_threads, threading.active_count())
+	result = conn.recv()
+	bot.running = False
+	bot_thread.join(5)
+	server.join(5)
+
+	latencies = result["latencies"]
+	peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+	print(f"engine:        {args.engine}")
+	print(f"chats:         {args.chats} x {args.rounds} rounds, {result['updates']} updates"
+		+ ("" if result["completed"] else " (TIMED OUT)"))
+	print(f"throughput:    {result['updates'] / result['elapsed']:.0f} updates/s ({result['elapsed']:.2f}s)")
+	print(f"update->reply: p50 {percentile(latencies, 0.5) * 1000:.1f}ms, p99 {percentile(latencies, 0.99) * 1000:.1f}ms")
+	print(f"peak threads:  {peak_threads}")
+	print(f"peak RSS:      {peak_rss:.1f} MiB")
+	print(f"api calls:     {result['calls']}")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,33 @@
+"""decode/encode cost of a getUpdates batch for every installed JSON backend
+
+run with: python benchmarks/bench_json.py [recorded_response.json]
+without an argument a synthetic batch of 100 message updates is used"""
+
+import os, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from telegram_api import JSONCodec
+
+from bench_parsing import make_message
+
+def load_batch() -> bytes:
+	if len(sys.argv) > 1:
+		with open(sys.argv[1], "rb") as f:
+			return f.read()
+	updates = [{"update_id": i, "message": make_message(i + 2, f"/quiz message number {i}")} for i in range(100)]
+	return JSONCodec("json").dumps({"ok": True, "result": updates})
+
+if __name__ == "__main__":
+	batch = load_batch()
+	keyboard = {"inline_keyboard": [[{"text": f"answer {i}", "callback_data": f"answer {i}"}] for i in range(4)]}
+	number = 200
+	print(f"batch size: {len(batch) / 1024:.1f} KiB")
+	for backend in JSONCodec.BACKENDS:
+		if not JSONCodec.is_available(backend):
+			print(f"{backend:>7}: not installed")
+			continue
+		codec = JSONCodec(backend)
+		decode = min(timeit.repeat(lambda: codec.loads(batch), number=number, repeat=5)) / number
+		encode = min(timeit.repeat(lambda: codec.dumps(keyboard), number=number * 100, repeat=5)) / (number * 100)
+		print(f"{backend:>7}: decode batch {decode * 1e3:7.3f} ms, encode keyboard {encode * 1e6:6.2f} us")
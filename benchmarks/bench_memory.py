@@ -0,0 +1,45 @@
+"""bytes per long-lived Message: regular objects vs. compact (__slots__, no raw) objects,
+and the same for a keyboard built with make(), which has no raw to drop
+
+run with: python benchmarks/bench_memory.py"""
+
+import os, sys, json, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from telegram_api import Message, InlineKeyboardMarkup, InlineKeyboardButton
+
+from bench_parsing import make_message
+
+def measure(build, count: int=5000) -> float:
+	payloads = [json.dumps(make_message(i + 2, f"/quiz message number {i}")) for i in range(count)]
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	# the raw dicts are created inside build, so dropping raw really frees them
+	kept = [build(json.loads(p)) for p in payloads]
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	assert len(kept) == count
+	return (after - before) / count
+
+def regular(data: dict) -> Message:
+	message = Message(data)
+	message._materialize()
+	return message
+
+def compact(data: dict) -> Message:
+	return Message(data).compact(drop_raw=True)
+
+def compact_keep_raw(data: dict) -> Message:
+	return Message(data).compact(drop_raw=False)
+
+def keyboard(data: dict) -> InlineKeyboardMarkup:
+	return InlineKeyboardMarkup.make([[InlineKeyboardButton.make(data["text"], callback_data=str(data["message_id"]))]])
+
+def compact_keyboard(data: dict) -> InlineKeyboardMarkup:
+	return keyboard(data).compact()
+
+if __name__ == "__main__":
+	for name, build in [("regular", regular), ("compact, raw kept", compact_keep_raw), ("compact", compact),
+			("keyboard", keyboard), ("compact keyboard", compact_keyboard)]:
+		print(f"{name:>18}: {measure(build):8.0f} bytes/message")
@@ -0,0 +1,49 @@
+"""per-update parsing cost: lazy sub-objects vs. building everything up front
+
+run with: python benchmarks/bench_parsing.py"""
+
+import os, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from telegram_api import ApiObject, Update
+
+USER = {"id": 12345, "is_bot": False, "first_name": "Ada", "last_name": "Lovelace", "username": "ada", "language_code": "en"}
+CHAT = {"id": 12345, "type": "private", "first_name": "Ada", "last_name": "Lovelace", "username": "ada"}
+
+def make_message(message_id: int, text: str, with_reply: bool=True) -> dict:
+	message = {
+		"message_id": message_id, "date": 1650000000, "chat": CHAT, "from": USER, "text": text,
+		"entities": [{"type": "bot_command", "offset": 0, "length": 5}, {"type": "mention", "offset": 6, "length": 4}],
+		"photo": [{"file_id": f"f{i}", "file_unique_id": f"u{i}", "width": 90 * i, "height": 90 * i} for i in range(1, 4)],
+	}
+	if with_reply:
+		message["reply_to_message"] = make_message(message_id - 1, "previous message", with_reply=False)
+	return message
+
+RAW_UPDATE = {"update_id": 1, "message": make_message(2, "/quiz @bob some text")}
+
+def materialize(obj: any) -> None:
+	"""builds every sub-object, which is what Message.__init__ used to do eagerly"""
+	if isinstance(obj, ApiObject):
+		obj._materialize()
+		for value in list(obj.__dict__.values()):
+			materialize(value)
+	elif isinstance(obj, list):
+		for value in obj:
+			materialize(value)
+
+def lazy_access() -> None:
+	update = Update(RAW_UPDATE)
+	update.message.is_command() and update.message.text
+
+def eager_access() -> None:
+	update = Update(RAW_UPDATE)
+	materialize(update)
+	update.message.is_command() and update.message.text
+
+if __name__ == "__main__":
+	number = 20000
+	for name, func in [("eager", eager_access), ("lazy", lazy_access)]:
+		seconds = min(timeit.repeat(func, number=number, repeat=5))
+		print(f"{name:>6}: {seconds / number * 1e6:7.2f} us/update")
@@ -0,0 +1,86 @@
+"""throughput of CPU-bound handlers with ShardedRunner, for a growing number of shards
+
+run with: python benchmarks/bench_sharded.py [--shards 1,2,4] [--chats 1000] [--work 20000]
+
+Every handler burns --work iterations of pure Python before it answers, so a
+single process is bound by the GIL however many worker threads it has. The
+same script as bench_end_to_end.py is played against the fake Bot API (one
+update per chat and round) once per shard count. Speedup is relative to the
+first entry of --shards, and can't exceed the number of free cores: the fake
+server and the poller need some CPU, too."""
+
+import argparse, multiprocessing, os, threading
+
+from bench_end_to_end import load_teleasy, serve_fake_api, percentile
+
+def burn(iterations: int) -> int:
+	total = 0
+	for i in range(iterations):
+		total += i * i
+	return total
+
+def make_bot_factory(teleasy, base_url: str, args):
+	def make_bot():
+		bot = teleasy.TelegramBot("BENCH", pool_size=args.pool_size, base_url=base_url)
+		bot.config.set_worker_pool(max_workers=args.workers)
+		bot.config.set_long_polling(timeout=1, limit=100)
+		bot.api.rate_limiter = None
+
+		@bot.on_command("echo")
+		def echo(chat):
+			burn(args.work)
+			chat.print("echo")
+
+		@bot.on_callback_query
+		def pressed(chat):
+			burn(args.work)
+			chat.print("pressed")
+
+		return bot
+	return make_bot
+
+def run(teleasy, shards: int, args) -> dict:
+	conn, child_conn = multiprocessing.Pipe()
+	server = multiprocessing.Process(target=serve_fake_api,
+		args=(child_conn, args.chats, args.rounds, args.callback_every, args.timeout), daemon=True)
+	server.start()
+	base_url = conn.recv()
+
+	runner = teleasy.ShardedRunner(make_bot_factory(teleasy, base_url, args), num_shards=shards)
+	runner_thread = threading.Thread(target=runner.start, daemon=True)
+	runner_thread.start()
+	conn.send("start")
+	result = conn.recv()
+	runner.running = False
+	runner_thread.join(30)
+	server.join(5)
+	result["restarts"] = sum(runner.restarts)
+	return result
+
+def main() -> None:
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--shards", default="1,2,4")
+	parser.add_argument("--chats", type=int, default=1000)
+	parser.add_argument("--rounds", type=int, default=2)
+	parser.add_argument("--callback-every", type=int, default=4)
+	parser.add_argument("--work", type=int, default=20000)
+	parser.add_argument("--workers", type=int, default=16)
+	parser.add_argument("--pool-size", type=int, default=10)
+	parser.add_argument("--timeout", type=float, default=300.0)
+	args = parser.parse_args()
+
+	teleasy = load_teleasy()
+	print(f"cores: {os.cpu_count()}, {args.chats} chats x {args.rounds} rounds, {args.work} iterations per handler")
+	print(f"{'shards':>6}{'updates/s':>12}{'speedup':>9}{'p50 ms':>9}{'p99 ms':>9}{'restarts':>10}")
+	baseline = None
+	for shards in [int(s) for s in args.shards.split(",")]:
+		result = run(teleasy, shards, args)
+		throughput = result["updates"] / result["elapsed"]
+		baseline = baseline or throughput
+		latencies = result["latencies"]
+		print(f"{shards:>6}{throughput:>12.0f}{throughput / baseline:>8.2f}x"
+			f"{percentile(latencies, 0.5) * 1000:>9.1f}{percentile(latencies, 0.99) * 1000:>9.1f}{result['restarts']:>10}"
+			+ ("" if result["completed"] else "  (TIMED OUT)"))
+
+if __name__ == "__main__":
+	main()
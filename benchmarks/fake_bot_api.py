@@ -0,0 +1,161 @@
+"""local stand-in for the Bot API: serves scripted getUpdates batches and records the bot's calls
+
+	api = FakeBotAPI()
+	api.add_updates([make_message_update(chat_id, "/echo hi") for chat_id in range(1, 1001)])
+	bot = TelegramBot("TOKEN", base_url=api.base_url)
+
+The time an update is handed out by getUpdates is remembered per chat, the
+next sendMessage to that chat counts as its reply (see latencies)."""
+
+import collections, itertools, json, threading, time
+
+from typing import List
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qsl, urlsplit
+
+def make_chat(chat_id: int) -> dict:
+	return {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"}
+
+def make_user(chat_id: int) -> dict:
+	return {"id": chat_id, "is_bot": False, "first_name": f"User {chat_id}"}
+
+def make_message_update(chat_id: int, text: str) -> dict:
+	message = {"message_id": 1, "date": int(time.time()), "chat": make_chat(chat_id), "from": make_user(chat_id), "text": text}
+	if text.startswith("/"):
+		message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split(" ")[0])}]
+	return {"message": message}
+
+def make_callback_update(chat_id: int, data: str) -> dict:
+	message = {"message_id": 1, "date": int(time.time()), "chat": make_chat(chat_id), "text": "keyboard"}
+	return {"callback_query": {"id": f"{chat_id}-{time.monotonic_ns()}", "from": make_user(chat_id),
+		"chat_instance": str(chat_id), "message": message, "data": data}}
+
+def update_chat_id(update: dict) -> int:
+	if "message" in update:
+		return update["message"]["chat"]["id"]
+	return update["callback_query"]["message"]["chat"]["id"]
+
+class FakeBotAPI:
+
+	def __init__(self, host: str="127.0.0.1", port: int=0, record_calls: bool=True):
+		self.record_calls: bool = record_calls
+		self.calls: list = list()
+		self.call_counts = collections.Counter()
+		self.latencies: List[float] = list()
+		self._updates = collections.deque()
+		self._next_update_id: int = 1
+		self._served = dict()
+		self._next_message_id: int = 1
+		self._condition = threading.Condition()
+		self.httpd = ThreadingHTTPServer((host, port), self._make_request_handler())
+		self.httpd.daemon_threads = True
+		self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+		self.thread.start()
+
+	@property
+	def base_url(self) -> str:
+		host, port = self.httpd.server_address[:2]
+		return f"http://{host}:{port}"
+
+	def add_updates(self, updates: list) -> None:
+		"""queues raw updates (without update_id), they are served in order by getUpdates"""
+		with self._condition:
+			for update in updates:
+				self._updates.append({"update_id": self._next_update_id, **update})
+				self._next_update_id += 1
+			self._condition.notify_all()
+
+	def wait_for_calls(self, method: str, count: int, timeout: float=None) -> bool:
+		deadline = None if timeout is None else time.monotonic() + timeout
+		with self._condition:
+			while self.call_counts[method] < count:
+				remaining = None if deadline is None else deadline - time.monotonic()
+				if remaining is not None and remaining <= 0:
+					return False
+				self._condition.wait(remaining)
+		return True
+
+	def close(self) -> None:
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+	def _get_updates(self, params: dict) -> list:
+		offset = int(params.get("offset", 0))
+		limit = int(params.get("limit", 100))
+		deadline = time.monotonic() + float(params.get("timeout", 0))
+		with self._condition:
+			# like Telegram, updates below offset are confirmed and dropped
+			while self._updates and self._updates[0]["update_id"] < offset:
+				self._updates.popleft()
+			while not self._updates and time.monotonic() < deadline:
+				self._condition.wait(deadline - time.monotonic())
+			batch = list(itertools.islice(self._updates, limit))
+			now = time.perf_counter()
+			for update in batch:
+				# served again if the bot didn't confirm it, the first time counts
+				if not update.get("_served"):
+					update["_served"] = True
+					self._served.setdefault(update_chat_id(update), collections.deque()).append(now)
+		return [{k: v for k, v in update.items() if k != "_served"} for update in batch]
+
+	def _send_message(self, params: dict) -> dict:
+		chat_id = int(params["chat_id"])
+		now = time.perf_counter()
+		with self._condition:
+			served = self._served.get(chat_id)
+			if served:
+				self.latencies.append(now - served.popleft())
+			message_id = self._next_message_id
+			self._next_message_id += 1
+		return {"message_id": message_id, "date": int(time.time()), "chat": make_chat(chat_id), "text": params.get("text", "")}
+
+	def handle(self, method: str, params: dict) -> any:
+		if method == "getUpdates":
+			result = self._get_updates(params)
+		elif method == "sendMessage":
+			result = self._send_message(params)
+		elif method == "getMe":
+			result = {"id": 1, "is_bot": True, "first_name": "Fake Bot", "username": "fake_bot"}
+		else:
+			result = True
+		if method != "getUpdates":
+			with self._condition:
+				self.call_counts[method] += 1
+				if self.record_calls:
+					self.calls.append((time.perf_counter(), method, params))
+				self._condition.notify_all()
+		return result
+
+	def _make_request_handler(self) -> type:
+		server = self
+
+		class FakeRequestHandler(BaseHTTPRequestHandler):
+			# keep-alive, the bot reuses its pooled connections
+			protocol_version = "HTTP/1.1"
+			# headers and body are separate writes, Nagle would delay every response
+			disable_nagle_algorithm = True
+
+			def _handle(self, body: bytes) -> None:
+				url = urlsplit(self.path)
+				params = dict(parse_qsl(url.query))
+				if body:
+					params.update(parse_qsl(body.decode("utf-8")))
+				method = url.path.rsplit("/", 1)[-1]
+				out = json.dumps({"ok": True, "result": server.handle(method, params)}).encode("utf-8")
+				self.send_response(200)
+				self.send_header("Content-Type", "application/json")
+				self.send_header("Content-Length", str(len(out)))
+				self.end_headers()
+				self.wfile.write(out)
+
+			def do_GET(self):
+				self._handle(b"")
+
+			def do_POST(self):
+				self._handle(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+			def log_message(self, format, *args):
+				pass
+
+		return FakeRequestHandler
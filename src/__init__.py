@@ -1,11 +1,17 @@
-import time, threading, datetime, re
+import time, threading, datetime, re, collections, asyncio, inspect, json, os, sqlite3, heapq, itertools, cProfile, pstats, io
+import logging, logging.handlers, queue, random, sys, multiprocessing, signal, zlib, copy, hmac
 
-from typing import List
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from typing import List, Optional
 
 from enum import Enum
 
 from telegram_api import *
 
+# a library only logs, the application decides where records go
+logging.getLogger("teleasy").addHandler(logging.NullHandler())
+
 class HandlerType(Enum):
 	COMMAND = 1
 	NORMAL_MESSAGE = 2
@@ -25,6 +31,126 @@ class TimeoutError(TeleasyError):
 class StopEvent(TeleasyError):
 	pass
 
+class Waiter:
+	"""parks a handler thread until an answer for its chat is delivered or its timer expires"""
+
+	def __init__(self):
+		self.event = threading.Event()
+		self.result = None
+		self.timed_out: bool = False
+		self.timer = None
+		self._lock = threading.Lock()
+
+	def resolve(self, result: any) -> bool:
+		"""returns False if the waiter was already resolved or expired"""
+		with self._lock:
+			if self.event.is_set():
+				return False
+			self.result = result
+			self.event.set()
+			return True
+
+	def expire(self) -> bool:
+		with self._lock:
+			if self.event.is_set():
+				return False
+			self.timed_out = True
+			self.event.set()
+			return True
+
+	def wait(self, timeout: float=None) -> bool:
+		return self.event.wait(timeout)
+
+class Timer:
+	__slots__ = ("deadline", "seq", "func", "args", "cancelled")
+
+	def __init__(self, deadline: float, seq: int, func, args: tuple):
+		self.deadline: float = deadline
+		self.seq: int = seq
+		self.func = func
+		self.args: tuple = args
+		self.cancelled: bool = False
+
+	def __lt__(self, other: "Timer") -> bool:
+		return (self.deadline, self.seq) < (other.deadline, other.seq)
+
+def _report_error(on_error, error: Exception, source: str) -> None:
+	"""errors nobody handled, on the teleasy logger unless a bot takes them"""
+	if on_error is not None:
+		on_error(error)
+	else:
+		logging.getLogger("teleasy").error(f"Uncaught error in {source}", exc_info=error)
+
+class TimerService:
+	"""one thread and a heap for every pending timeout of a bot
+
+	schedule and cancel are O(log n). Cancelled timers stay in the heap until they
+	reach the top, or until they make up half of it and the heap is rebuilt.
+	Callbacks run on the timer thread and must only hand work off without blocking
+	(e.g. Dispatcher.submit with block=False)."""
+
+	def __init__(self):
+		self._heap: list = list()
+		self._condition = threading.Condition()
+		self._seq = itertools.count()
+		self._cancelled: int = 0
+		self._thread: threading.Thread = None
+		self._running: bool = True
+		# called with the exception of a callback that raised, the bot logs it
+		self.on_error = None
+
+	def __len__(self) -> int:
+		return len(self._heap) - self._cancelled
+
+	def schedule(self, delay: float, func, *args) -> Timer:
+		timer = Timer(time.monotonic() + delay, next(self._seq), func, args)
+		with self._condition:
+			heapq.heappush(self._heap, timer)
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, daemon=True)
+				self._thread.start()
+			if self._heap[0] is timer:
+				self._condition.notify()
+		return timer
+
+	def cancel(self, timer: Timer) -> None:
+		with self._condition:
+			# func is None once the timer has fired
+			if timer.cancelled or timer.func is None:
+				return
+			timer.cancelled = True
+			self._cancelled += 1
+			if self._cancelled > 64 and self._cancelled * 2 > len(self._heap):
+				self._heap = [t for t in self._heap if not t.cancelled]
+				heapq.heapify(self._heap)
+				self._cancelled = 0
+
+	def _run(self) -> None:
+		while True:
+			with self._condition:
+				while self._running:
+					while self._heap and self._heap[0].cancelled:
+						heapq.heappop(self._heap)
+						self._cancelled -= 1
+					now = time.monotonic()
+					if self._heap and self._heap[0].deadline <= now:
+						break
+					self._condition.wait(self._heap[0].deadline - now if self._heap else None)
+				if not self._running:
+					return
+				timer = heapq.heappop(self._heap)
+				func, args = timer.func, timer.args
+				timer.func = None
+			try:
+				func(*args)
+			except Exception as error:
+				_report_error(self.on_error, error, "timer callback")
+
+	def shutdown(self) -> None:
+		with self._condition:
+			self._running = False
+			self._condition.notify()
+
 class TeleasyUtils:
 
 	@staticmethod
@@ -52,8 +178,33 @@ class TeleasyUtils:
 			return list()
 		return arg_list[1:]
 
+	_keyboard_cache = dict()
+	_keyboard_cache_size = 1024
+
 	@staticmethod
-	def make_easy_inlinekeyboard(buttons: List[List[str]], num_rows: int=1, callbacks: List[str]=None) -> InlineKeyboardMarkup:
+	def _cached_keyboard(key: tuple, build) -> ApiObject:
+		"""keyboards are frozen and shared between equal calls, so their JSON is encoded only once"""
+		try:
+			keyboard = TeleasyUtils._keyboard_cache.get(key)
+		except TypeError:
+			return build().freeze()
+		if keyboard is None:
+			if len(TeleasyUtils._keyboard_cache) >= TeleasyUtils._keyboard_cache_size:
+				TeleasyUtils._keyboard_cache.clear()
+			keyboard = TeleasyUtils._keyboard_cache[key] = build().freeze()
+		return keyboard
+
+	@staticmethod
+	def make_easy_inlinekeyboard(buttons: List[List[str]], num_rows: int=1, callbacks: List[str]=None,
+			cache: bool=False) -> InlineKeyboardMarkup:
+		"""with cache, the keyboard is frozen and shared between equal calls, don't modify it"""
+		if not cache:
+			return TeleasyUtils._build_inlinekeyboard(buttons, num_rows, callbacks)
+		key = ("inline", tuple(buttons), num_rows, None if callbacks is None else tuple(callbacks))
+		return TeleasyUtils._cached_keyboard(key, lambda: TeleasyUtils._build_inlinekeyboard(buttons, num_rows, callbacks))
+
+	@staticmethod
+	def _build_inlinekeyboard(buttons: List[List[str]], num_rows: int=1, callbacks: List[str]=None) -> InlineKeyboardMarkup:
 		keyboard_list = list()
 		temp_list = list()
 		for i, button in enumerate(buttons):
@@ -67,7 +218,15 @@ class TeleasyUtils:
 		return keyboard
 	
 	@staticmethod
-	def make_easy_keyboard(buttons: List[List[str]], num_rows: int=1) -> ReplyKeyboardMarkup:
+	def make_easy_keyboard(buttons: List[List[str]], num_rows: int=1, cache: bool=False) -> ReplyKeyboardMarkup:
+		"""with cache, the keyboard is frozen and shared between equal calls, don't modify it"""
+		if not cache:
+			return TeleasyUtils._build_keyboard(buttons, num_rows)
+		key = ("reply", tuple(buttons), num_rows)
+		return TeleasyUtils._cached_keyboard(key, lambda: TeleasyUtils._build_keyboard(buttons, num_rows))
+
+	@staticmethod
+	def _build_keyboard(buttons: List[List[str]], num_rows: int=1) -> ReplyKeyboardMarkup:
 		keyboard_list = list()
 		temp_list = list()
 		for button in buttons:
@@ -122,7 +281,7 @@ class ChatInstance:
 		time.sleep(seconds)
 
 	def select(self, text: str, options: List[str], columns:int=1, callbacks: List[str]=None, disappering_buttons=True) -> str:
-		keyboard = TeleasyUtils.make_easy_inlinekeyboard(options, columns, callbacks)
+		keyboard = TeleasyUtils.make_easy_inlinekeyboard(options, columns, callbacks, cache=True)
 		message = self.bot.send_message(self.chat, text, reply_markup=keyboard)
 		try:
 			callback = self.bot.await_callback(self).data
@@ -133,7 +292,7 @@ class ChatInstance:
 		return callback
 
 	def input_keyboard(self, text: str, options: List[str], columns:int=1) -> Message:
-		keyboard = TeleasyUtils.make_easy_keyboard(options, columns)
+		keyboard = TeleasyUtils.make_easy_keyboard(options, columns, cache=True)
 		self.bot.send_message(self.chat, text, reply_markup=keyboard)
 		return self.bot.await_answer(self, None)
 
@@ -156,8 +315,159 @@ class ChatInstance:
 	def arguments(self) -> List[str]:
 		return TeleasyUtils.parse_args(self.message.text)
 
+class Dispatcher:
+	"""bounded worker pool: jobs sharing a key (chat id) run in submission order,
+	jobs with different keys run in parallel on at most max_workers threads
+
+	A job waiting for user input calls park(): until unpark() it no longer takes one
+	of the max_workers slots, and neither it nor the jobs queued behind it count
+	towards max_queue_size, so open dialogues can't stall the bot."""
+
+	def __init__(self, max_workers: int=16, max_queue_size: int=1000):
+		self.max_workers: int = max_workers
+		self.max_queue_size: int = max_queue_size
+		self._condition = threading.Condition()
+		self._key_queues = dict()
+		self._ready_keys = collections.deque()
+		self._workers: List[threading.Thread] = list()
+		self._idle_workers: int = 0
+		self._num_pending: int = 0
+		self._num_parked: int = 0
+		# parked jobs and the jobs queued behind them, they can't make progress on their own
+		self._num_blocked: int = 0
+		self._parked_keys: set = set()
+		self._running: bool = True
+		self._local = threading.local()
+		# called while a producer waits for queue space and jobs keep finishing
+		self.on_progress = None
+		# called with the exception of a job that raised, the bot logs it
+		self.on_error = None
+
+	@property
+	def num_pending(self) -> int:
+		return self._num_pending
+
+	@property
+	def num_parked(self) -> int:
+		return self._num_parked
+
+	@property
+	def num_workers(self) -> int:
+		return len(self._workers)
+
+	def submit(self, key: any, func, *args, block: bool=True) -> None:
+		"""a key of None gives the job its own queue. With block=False the job is queued
+		even if the queue is full, for callers that must never wait (the timer thread)"""
+		if key is None:
+			key = object()
+		with self._condition:
+			# block the producer (polling loop) when the queue is full, but never a worker
+			# itself, as that worker might be the one needed to drain the queue
+			if block and not getattr(self._local, "is_worker", False):
+				while self._running and self._num_pending - self._num_blocked >= self.max_queue_size:
+					self._condition.wait()
+					if self.on_progress is not None:
+						self.on_progress()
+			if not self._running:
+				raise TeleasyError("Dispatcher has been shut down")
+			if key in self._key_queues:
+				self._key_queues[key].append((func, args))
+				if key in self._parked_keys:
+					self._num_blocked += 1
+			else:
+				self._key_queues[key] = collections.deque([(func, args)])
+				self._ready_keys.append(key)
+			self._num_pending += 1
+			self._add_worker()
+			self._condition.notify_all()
+
+	def _add_worker(self) -> None:
+		"""starts a worker if none is idle and a slot is free, parked workers don't take one"""
+		if self._ready_keys and self._idle_workers == 0 and len(self._workers) - self._num_parked < self.max_workers:
+			worker = threading.Thread(target=self._work, daemon=True)
+			self._workers.append(worker)
+			worker.start()
+
+	def park(self) -> bool:
+		"""called by a job before it waits for user input, returns False outside of a worker"""
+		key = getattr(self._local, "key", None)
+		if key is None:
+			return False
+		with self._condition:
+			self._num_parked += 1
+			self._parked_keys.add(key)
+			self._num_blocked += 1 + len(self._key_queues[key])
+			self._add_worker()
+			# producers waiting for queue space may go on
+			self._condition.notify_all()
+		return True
+
+	def unpark(self) -> None:
+		key = self._local.key
+		with self._condition:
+			self._num_parked -= 1
+			self._parked_keys.discard(key)
+			self._num_blocked -= 1 + len(self._key_queues[key])
+
+	def _work(self) -> None:
+		self._local.is_worker = True
+		while True:
+			with self._condition:
+				self._idle_workers += 1
+				while self._running and not self._ready_keys:
+					if len(self._workers) - self._num_parked > self.max_workers:
+						# parked jobs came back, leave so the pool shrinks to max_workers again
+						self._idle_workers -= 1
+						self._workers.remove(threading.current_thread())
+						return
+					self._condition.wait()
+				self._idle_workers -= 1
+				if not self._ready_keys:
+					return
+				# the key stays in _key_queues while running, so new jobs for it
+				# are only appended and never scheduled on a second worker
+				key = self._ready_keys.popleft()
+				func, args = self._key_queues[key].popleft()
+			self._local.key = key
+			try:
+				func(*args)
+			except Exception as error:
+				_report_error(self.on_error, error, "dispatcher job")
+			self._local.key = None
+			with self._condition:
+				self._num_pending -= 1
+				if self._key_queues[key]:
+					self._ready_keys.append(key)
+				else:
+					del self._key_queues[key]
+				self._condition.notify_all()
+
+	def join(self, timeout: float=None) -> bool:
+		"""waits until every submitted job has finished, returns False on timeout"""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		with self._condition:
+			while self._num_pending > 0:
+				remaining = None if deadline is None else deadline - time.monotonic()
+				if remaining is not None and remaining <= 0:
+					return False
+				self._condition.wait(remaining)
+		return True
+
+	def shutdown(self, wait: bool=True) -> None:
+		"""already queued jobs are still run before the workers exit"""
+		with self._condition:
+			self._running = False
+			self._condition.notify_all()
+		if wait:
+			for worker in list(self._workers):
+				if worker is not threading.current_thread():
+					worker.join()
+
 class Handler:
 
+	# these answer a chat whose handler is still running, queued behind it they'd come too late
+	UNORDERED_TYPES = (HandlerType.IGNORED_MESSAGE, HandlerType.IGNORED_CALLBACK_QUERY)
+
 	def __init__(self, handler_type: str, func, command=None):
 		self.func = func
 		self.type: int = handler_type
@@ -165,36 +475,54 @@ class Handler:
 		# optional
 		self.command: str = command
 
-	def run(self, chat_instance: ChatInstance, bot: "TelegramBot", *args) -> threading.Thread:
+	@property
+	def name(self) -> str:
+		"""the command, or the handler type for other handlers"""
+		return f"/{self.command}" if self.command else self.type.name.lower()
+
+	def run(self, chat_instance: ChatInstance, bot: "TelegramBot", *args, ordered: bool=True, block: bool=True) -> None:
+		"""ordered handlers of a chat run one after another, the others get their own queue.
+		block=False never waits for space in the dispatcher queue"""
 		def threaded_handler_func(chat_instance):
 			try:
 				if chat_instance == None:
 					self.func(None, *args)
 					raise StopEvent()
 				
-				bot.activate_chat(chat_instance.chat.id)
 				return_val = self.func(chat_instance, *args)
 				if isinstance(return_val, str) and chat_instance._update.has(Message) and return_val:
 					bot.send_message(chat_instance.chat, str(return_val))
 				raise StopEvent()
 			except StopEvent:
-				if chat_instance != None:
-					bot.deactivate_chat(chat_instance.chat.id)
+				pass
 			except Exception as error:
+				bot._count_handler_error(self)
 				if chat_instance != None:
 					if chat_instance._on_error:
-						bot._run_handler_func(chat_instance._on_error, chat_instance, error)
+						bot._run_handler_func(chat_instance._on_error, chat_instance, error, ordered=False)
 					elif bot.global_error_handler:
-						bot._run_handler_func(bot.global_error_handler, chat_instance, error)
+						bot._run_handler_func(bot.global_error_handler, chat_instance, error, ordered=False)
 					else:
 						raise
 				elif bot.global_error_handler:
-					bot._run_handler_func(bot.global_error_handler, chat_instance, error)
+					bot._run_handler_func(bot.global_error_handler, chat_instance, error, ordered=False)
 				else:
 					raise error
-		new_thread = threading.Thread(target=threaded_handler_func, args=(chat_instance,))
-		new_thread.start()
-		return new_thread
+			finally:
+				if chat_instance != None:
+					bot.deactivate_chat(chat_instance.chat.id)
+		key = None
+		if chat_instance != None:
+			# marked when queued, an answer arriving before the job starts has to see the chat as busy
+			bot.activate_chat(chat_instance.chat.id)
+			if ordered and self.type not in self.UNORDERED_TYPES:
+				key = chat_instance.chat.id
+		try:
+			bot.dispatcher.submit(key, bot._measure_handler, self, threaded_handler_func, chat_instance, block=block)
+		except Exception:
+			if chat_instance != None:
+				bot.deactivate_chat(chat_instance.chat.id)
+			raise
 
 	def __getitem__(self, key: str) -> any:
 		return self.__dict__[key]
@@ -207,6 +535,20 @@ class TeleasyBotConfig:
 		self.console_logging: bool = False
 		self.logging_prefix: str = "[TELEGRAM-BOT]"
 		self.logging_time_format: str = "[%d/%m/%Y, %H:%M:%S]"
+		self.logging_level: int = logging.INFO
+		self.json_logging: bool = False
+		self.log_sample_rates: dict = dict()
+		self.log_stream = None
+		self.log_queue_size: int = 10000
+		self.polling_timeout: int = 30
+		self.polling_limit: int = 100
+		self.allowed_updates: List[str] = None
+		self.max_workers: int = 16
+		self.max_queue_size: int = 1000
+		self.compact_messages: bool = False
+		self.routing_workers: int = 4
+		# None keeps dialogue states in memory
+		self.conversation_store: str or ConversationStore = None
 
 	def set_logging_prefix(self, new_prefix: str) -> None:
 		"""default value is \"[TELEGRAM-BOT]\""""
@@ -220,10 +562,66 @@ class TeleasyBotConfig:
 		"""may be disabled by passing False as argument"""
 		self.console_logging = new_val
 
+	def enable_json_logging(self, new_val=True) -> None:
+		"""console log lines become JSON objects with the event name and its fields"""
+		self.json_logging = new_val
+
+	def set_logging_level(self, level: int=logging.INFO) -> None:
+		"""lowest level written by console logging, logging.DEBUG adds a line per finished handler"""
+		self.logging_level = level
+
+	def set_log_sampling(self, **rates: float) -> None:
+		"""keeps only this fraction of an event, e.g. set_log_sampling(sent_message=0.01).
+		Sampled records carry their rate, a rate of None logs every event again"""
+		for event, rate in rates.items():
+			if rate is None:
+				self.log_sample_rates.pop(event, None)
+			else:
+				self.log_sample_rates[event] = rate
+
+	def set_log_output(self, stream=None, queue_size: int=10000) -> None:
+		"""stream console logging writes to (stdout if None), must be called before the first log line.
+		Records beyond queue_size are dropped instead of blocking the bot"""
+		self.log_stream = stream
+		self.log_queue_size = queue_size
+
 	def set_parse_mode(self, parse_mode: ParseMode) -> None:
 		"""see https://core.telegram.org/bots/api#formatting-options"""
 		self.parse_mode = parse_mode
 
+	def set_long_polling(self, timeout: int=30, limit: int=100, allowed_updates: List[str]=None) -> None:
+		"""timeout is the server-side wait in seconds (0 disables long polling), limit is the batch size (1-100)"""
+		self.polling_timeout = timeout
+		self.polling_limit = limit
+		self.allowed_updates = allowed_updates
+
+	def enable_compact_messages(self, new_val=True) -> None:
+		"""sent messages and received answers are stored as __slots__ based objects
+		without their raw dict, which saves memory for long-lived dialogues"""
+		self.compact_messages = new_val
+
+	def set_batch_dispatch(self, routing_workers: int=4) -> None:
+		"""updates of one getUpdates batch are routed on this many threads (per-chat order is kept)
+		while the next long poll is already running. 0 routes them one by one in the polling thread"""
+		self.routing_workers = routing_workers
+
+	def set_worker_pool(self, max_workers: int=16, max_queue_size: int=1000) -> None:
+		"""must be called before the bot is started. max_workers handlers run at the same time,
+		at most max_queue_size updates wait for a worker before polling blocks.
+
+		A handler waiting in chat.input() or chat.select() is parked (Dispatcher.park): its
+		thread no longer counts towards max_workers, so another one is started, and the
+		updates queued behind it don't count towards max_queue_size. When the answer arrives
+		it is unparked and the pool shrinks back to max_workers once the extra threads are idle.
+		Every waiting handler still holds a thread, use a dialogue for many open questions"""
+		self.max_workers = max_workers
+		self.max_queue_size = max_queue_size
+
+	def set_conversation_store(self, store: str or ConversationStore="conversations.sqlite3") -> None:
+		"""where dialogue states are kept: the path of a SQLite database (they then survive a
+		restart) or a ConversationStore. By default they are only kept in memory"""
+		self.conversation_store = store
+
 class HandlerException(TeleasyError):
 	pass
 
@@ -231,13 +629,25 @@ class HandlerList:
 
 	def __init__(self):
 		self.handlers = list()
+		# indices built at registration time, the first registered handler wins
+		self._by_type = dict()
+		self._by_command = dict()
+		self._by_command_lower = dict()
 
 	def add(self, handler: Handler) -> None:
 		if self.contains(handler.type) and handler.type != HandlerType.COMMAND:
 			raise HandlerException(f"Handler for type {handler.type} already registered")
 		self.handlers.append(handler)
+		self._by_type.setdefault(handler.type, handler)
+		if handler.command != None:
+			self._by_command.setdefault(handler.command, handler)
+			self._by_command_lower.setdefault(str(handler.command).lower(), handler)
 
 	def get(self, attr_val: any, attr_name="type", ignore_case: bool=True) -> Handler or None:
+		if attr_name == "type":
+			return self._by_type.get(attr_val)
+		if attr_name == "command":
+			return self.get_by_command(attr_val, ignore_case)
 		if ignore_case:
 			for handler in self.handlers:
 				if handler[attr_name] == None:
@@ -252,33 +662,624 @@ class HandlerList:
 			return None
 
 	def get_by_command(self, command: str, ignore_case: bool=True) -> Handler or None:
-		return self.get(command, "command", ignore_case)
+		if ignore_case:
+			return self._by_command_lower.get(str(command).lower())
+		return self._by_command.get(command)
 
 	def contains_command(self, command: str, ignore_case: bool=True) -> bool:
-		if ignore_case:
-			for handler in self.handlers:
-				if handler.command == None:
-					continue
-				if str(handler.command).lower() == str(command).lower():
-					return True
-			return False
-		else:
-			for handler in self.handlers:
-				if handler.command == command:
-					return True
-			return False
+		return self.get_by_command(command, ignore_case) != None
 
 	def contains(self, handler_type: int) -> bool:
-		for handler in self.handlers:
-			if handler.type == handler_type:
-				return True
-		return False
+		return handler_type in self._by_type
+
+class WebhookServer:
+	"""minimal HTTP listener that feeds Telegram update POSTs into a bot
+
+	Requests are handled one after another, so routing sees updates in the
+	order they arrive; the handlers themselves still run on the bot's workers."""
+
+	SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+	def __init__(self, bot: "TelegramBot", host: str="0.0.0.0", port: int=8443, path: str="/", secret_token: str=None):
+		self.bot = bot
+		self.path: str = path
+		self.secret_token: str = secret_token
+		self.httpd = HTTPServer((host, port), self._make_request_handler())
+
+	@property
+	def server_address(self) -> tuple:
+		return self.httpd.server_address
+
+	def _make_request_handler(self) -> type:
+		server = self
+
+		class WebhookRequestHandler(BaseHTTPRequestHandler):
+
+			def do_POST(self):
+				if self.path != server.path:
+					return self._respond(404)
+				# constant time, the comparison must not leak how much of the token matched
+				if server.secret_token and not hmac.compare_digest(
+						self.headers.get(server.SECRET_HEADER, "").encode("utf-8"), server.secret_token.encode("utf-8")):
+					return self._respond(403)
+				try:
+					length = int(self.headers.get("Content-Length", 0))
+					update = Update(json.loads(self.rfile.read(length)))
+				except (ValueError, KeyError, TypeError):
+					return self._respond(400)
+				# answer before routing, Telegram only waits for the status code
+				self._respond(200)
+				try:
+					server.bot.process_update(update)
+				except Exception as e:
+					server.bot.logerror(f"during webhook update: {e}", event="webhook_error")
+
+			def _respond(self, code: int) -> None:
+				self.send_response(code)
+				self.send_header("Content-Length", "0")
+				self.end_headers()
+
+			def log_message(self, format, *args):
+				pass
+
+		return WebhookRequestHandler
+
+	def serve_forever(self) -> None:
+		self.httpd.serve_forever(poll_interval=0.5)
+
+	def shutdown(self) -> None:
+		"""stops serve_forever, must be called from another thread"""
+		self.httpd.shutdown()
+
+	def close(self) -> None:
+		self.httpd.server_close()
+
+class MetricsServer:
+	"""serves Metrics in Prometheus text format on http://host:port/metrics from a daemon thread"""
+
+	CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+	def __init__(self, metrics: Metrics, host: str="127.0.0.1", port: int=9100, path: str="/metrics"):
+		self.metrics: Metrics = metrics
+		self.path: str = path
+		# further plain text pages, path -> function returning the page
+		self.pages: dict = dict()
+		self.httpd = ThreadingHTTPServer((host, port), self._make_request_handler())
+		self.httpd.daemon_threads = True
+		self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+		self.thread.start()
+
+	@property
+	def server_address(self) -> tuple:
+		return self.httpd.server_address
+
+	def _make_request_handler(self) -> type:
+		server = self
+
+		class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+			def do_GET(self):
+				path = self.path.split("?")[0]
+				if path == server.path:
+					body = server.metrics.to_prometheus().encode("utf-8")
+				elif path in server.pages:
+					body = server.pages[path]().encode("utf-8")
+				else:
+					self.send_response(404)
+					self.send_header("Content-Length", "0")
+					self.end_headers()
+					return
+				self.send_response(200)
+				self.send_header("Content-Type", server.CONTENT_TYPE)
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		return MetricsRequestHandler
+
+	def close(self) -> None:
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+class HandlerProfiler:
+	"""collects HandlerProfiles of sampled handler runs, see TelegramBot.enable_profiling
+
+	Profiles are aggregated per handler (the command, or the handler type for
+	other handlers) and can be read with report() while the bot is running."""
+
+	def __init__(self, commands: List[str]=None, sample_every: int=1, slow_threshold: float=1.0, functions: bool=False):
+		# None profiles every handler
+		self.commands: Optional[set] = None
+		if commands is not None:
+			self.commands = set(self._command_key(command) for command in commands)
+		self.sample_every: int = max(int(sample_every), 1)
+		self.slow_threshold: Optional[float] = slow_threshold
+		self.functions: bool = functions
+		self._runs = itertools.count()
+		self._lock = threading.Lock()
+		# name -> [runs, slow runs, wall, max wall, api time, api calls, wait time]
+		self._totals: dict = dict()
+		self._stats: dict = dict()
+		self.slow_profiles = collections.deque(maxlen=100)
+
+	@staticmethod
+	def _command_key(command: str) -> str:
+		return command[1:].lower() if command.startswith("/") else command.lower()
+
+	@staticmethod
+	def name_of(handler: Handler) -> str:
+		return handler.name
+
+	def enable_command(self, command: str) -> None:
+		"""profiles command from now on, also when only other commands were profiled so far"""
+		if self.commands is not None:
+			self.commands.add(self._command_key(command))
+
+	def disable_command(self, command: str) -> None:
+		if self.commands is None:
+			raise TeleasyError("profiling covers all handlers, pass commands to enable_profiling to pick some")
+		self.commands.discard(self._command_key(command))
+
+	def should_profile(self, handler: Handler) -> bool:
+		if self.commands is not None and (handler.command is None or self._command_key(handler.command) not in self.commands):
+			return False
+		return next(self._runs) % self.sample_every == 0
+
+	def call(self, profile: HandlerProfile, func, *args) -> any:
+		"""calls func, under cProfile if function profiling is on"""
+		if not self.functions:
+			return func(*args)
+		function_profile = cProfile.Profile()
+		try:
+			function_profile.enable()
+		except ValueError:
+			# another profiler is active, Python 3.12+ allows only one at a time
+			return func(*args)
+		try:
+			return func(*args)
+		finally:
+			function_profile.disable()
+			profile.stats = pstats.Stats(function_profile)
+
+	def add(self, profile: HandlerProfile) -> bool:
+		"""adds a finished run to the totals, returns True if it was slow"""
+		slow = self.slow_threshold is not None and profile.wall >= self.slow_threshold
+		with self._lock:
+			totals = self._totals.setdefault(profile.name, [0, 0, 0.0, 0.0, 0.0, 0, 0.0])
+			totals[0] += 1
+			totals[1] += slow
+			totals[2] += profile.wall
+			totals[3] = max(totals[3], profile.wall)
+			totals[4] += profile.api_time
+			totals[5] += profile.api_calls
+			totals[6] += profile.wait_time
+			if profile.stats is not None:
+				self._stats.setdefault(profile.name, pstats.Stats()).add(profile.stats)
+			if slow:
+				self.slow_profiles.append(profile)
+		return slow
+
+	def top_functions(self, name: str, limit: int=10, sort: str="cumulative") -> str:
+		"""the aggregated cProfile output of one handler, empty without function profiling"""
+		with self._lock:
+			stats = self._stats.get(name)
+			if stats is None:
+				return ""
+			out = io.StringIO()
+			stats.stream = out
+			stats.sort_stats(sort).print_stats(limit)
+		return out.getvalue()
+
+	def report(self, limit: int=10) -> str:
+		"""per handler averages in milliseconds, followed by the top functions if profiled"""
+		lines = [f"{'handler':<24}{'runs':>8}{'slow':>6}{'avg ms':>10}{'max ms':>10}{'api ms':>10}{'calls':>7}{'wait ms':>10}{'other ms':>10}"]
+		with self._lock:
+			totals = sorted(self._totals.items(), key=lambda item: item[1][2], reverse=True)
+		for name, (runs, slow, wall, max_wall, api_time, api_calls, wait_time) in totals:
+			other = max(wall - api_time - wait_time, 0.0)
+			lines.append(f"{name:<24}{runs:>8}{slow:>6}{wall / runs * 1000:>10.1f}{max_wall * 1000:>10.1f}"
+				f"{api_time / runs * 1000:>10.1f}{api_calls / runs:>7.1f}{wait_time / runs * 1000:>10.1f}{other / runs * 1000:>10.1f}")
+		for name, _ in totals:
+			functions = self.top_functions(name, limit)
+			if functions:
+				lines.append(f"\n{name}\n{functions}")
+		return "\n".join(lines) + "\n"
+
+	def dump(self, path: str) -> None:
+		"""writes report() to path, and the merged cProfile data of each handler to
+		path.<handler>.prof (readable with pstats or snakeviz)"""
+		with open(path, "w") as f:
+			f.write(self.report())
+		with self._lock:
+			for name, stats in self._stats.items():
+				stats.dump_stats(f"{path}.{name.strip('/')}.prof")
+
+	def reset(self) -> None:
+		with self._lock:
+			self._totals.clear()
+			self._stats.clear()
+			self.slow_profiles.clear()
+
+class LogFormatter(logging.Formatter):
+	"""formats teleasy records as "<prefix> <time> <message>" or, with json_logging, as one
+	JSON object per line. Follows the bot config at format time"""
+
+	def __init__(self, config: TeleasyBotConfig):
+		super().__init__()
+		self.config: TeleasyBotConfig = config
+
+	def format(self, record: logging.LogRecord) -> str:
+		if self.config.json_logging:
+			return self.format_json(record)
+		time_str = datetime.datetime.fromtimestamp(record.created).strftime(self.config.logging_time_format)
+		message = record.getMessage()
+		if record.levelno >= logging.ERROR:
+			message = f"[ERROR] {message}"
+		if record.exc_info:
+			message = f"{message}\n{self.formatException(record.exc_info)}"
+		return f"{self.config.logging_prefix} {time_str} {message}"
+
+	def format_json(self, record: logging.LogRecord) -> str:
+		entry = {"time": record.created, "level": record.levelname.lower(),
+			"event": getattr(record, "event", None), "message": record.getMessage()}
+		entry.update(getattr(record, "fields", None) or {})
+		sample_rate = getattr(record, "sample_rate", None)
+		if sample_rate is not None:
+			entry["sample_rate"] = sample_rate
+		if record.exc_info:
+			entry["exception"] = self.formatException(record.exc_info)
+		return json.dumps(entry, default=str)
+
+class LogListener(logging.handlers.QueueListener):
+	"""QueueListener whose queue holds (created, level, message, extra, console, forward, exc_info) tuples,
+	the LogRecord is only built in the listener thread. It goes to the listener's handlers
+	with console and to logger with forward"""
+
+	def __init__(self, queue, logger: logging.Logger, *handlers: logging.Handler):
+		super().__init__(queue, *handlers)
+		self.logger: logging.Logger = logger
+
+	def prepare(self, entry: tuple) -> logging.LogRecord:
+		if isinstance(entry, logging.LogRecord):
+			return entry
+		created, level, message, extra, console, forward, exc_info = entry
+		if isinstance(exc_info, BaseException):
+			exc_info = (type(exc_info), exc_info, exc_info.__traceback__)
+		record = self.logger.makeRecord(self.logger.name, level, __file__, 0, message, None, exc_info, extra=extra)
+		record.created = created
+		record.msecs = (created - int(created)) * 1000
+		return record
+
+	def handle(self, entry: tuple) -> None:
+		if isinstance(entry, logging.LogRecord):
+			return super().handle(entry)
+		record = self.prepare(entry)
+		console, forward = entry[4:6]
+		if console:
+			super().handle(record)
+		if forward:
+			self.logger.handle(record)
+
+class LogPipeline:
+	"""writes log records from a background thread (see LogListener), callers only put a
+	tuple on the queue. Beyond max_queue_size entries are dropped and counted instead"""
+
+	def __init__(self, handler: logging.Handler, max_queue_size: int=10000, logger: logging.Logger=None):
+		self.handler: logging.Handler = handler
+		self.max_queue_size: int = max_queue_size
+		# SimpleQueue.put is a fraction of Queue.put, the size bound is checked by hand
+		self.queue = queue.SimpleQueue()
+		self.dropped: int = 0
+		self.listener = LogListener(self.queue, logger if logger is not None else logging.getLogger("teleasy"), handler)
+		self.listener.start()
+
+	def put(self, level: int, message: any, extra: dict=None, console: bool=True, forward: bool=False,
+			exc_info: BaseException=None) -> None:
+		"""queues a line for the handler (console) and/or the logger (forward)"""
+		if self.queue.qsize() >= self.max_queue_size:
+			self.dropped += 1
+			return
+		self.queue.put((time.time(), level, message, extra, console, forward, exc_info))
+
+	def handle(self, record: logging.LogRecord) -> None:
+		if self.queue.qsize() >= self.max_queue_size:
+			self.dropped += 1
+			return
+		self.queue.put(record)
+
+	def close(self) -> None:
+		"""writes the queued records and stops the thread"""
+		self.listener.stop()
+		self.handler.close()
+
+class BroadcastResult:
+	"""per-recipient outcome of TelegramBot.broadcast"""
+
+	DELIVERED = "delivered"
+	BLOCKED = "blocked"
+	FAILED = "failed"
+
+	def __init__(self):
+		self.statuses = dict()
+		self.errors = dict()
+		self.skipped: int = 0
+		self.elapsed: float = 0.0
+
+	def _ids_with(self, status: str) -> List[int]:
+		return [chat_id for chat_id, s in self.statuses.items() if s == status]
+
+	@property
+	def delivered(self) -> List[int]:
+		return self._ids_with(self.DELIVERED)
+
+	@property
+	def blocked(self) -> List[int]:
+		return self._ids_with(self.BLOCKED)
+
+	@property
+	def failed(self) -> List[int]:
+		return self._ids_with(self.FAILED)
+
+	@property
+	def messages_per_second(self) -> float:
+		"""throughput of this run, recipients skipped through the checkpoint are not counted"""
+		sent = len(self.statuses) - self.skipped
+		return sent / self.elapsed if self.elapsed > 0 else 0.0
+
+	def __str__(self) -> str:
+		return (f"<teleasy.BroadcastResult delivered={len(self.delivered)} blocked={len(self.blocked)} "
+			f"failed={len(self.failed)} skipped={self.skipped} {self.messages_per_second:.1f} msg/s>")
+
+class ConversationState:
+	"""position of one chat in a Dialogue, written to the ConversationStore after every step.
+	answers must be JSON serializable"""
+
+	def __init__(self, chat_id: int, dialogue: str, step: str=None, answers: dict=None, prompt: str=None,
+			deadline: float=None, chat: dict=None):
+		self.chat_id: int = chat_id
+		self.dialogue: str = dialogue
+		self.step: str = step
+		self.answers: dict = answers if answers is not None else dict()
+		self.prompt: str = prompt
+		self.deadline: float = deadline
+		self.chat: dict = chat
+
+	def to_row(self) -> tuple:
+		return (self.chat_id, self.dialogue, self.step, json.dumps(self.answers), self.prompt,
+			self.deadline, json.dumps(self.chat))
+
+	@classmethod
+	def from_row(cls, row: tuple) -> "ConversationState":
+		chat_id, dialogue, step, answers, prompt, deadline, chat = row
+		return cls(chat_id, dialogue, step, json.loads(answers), prompt, deadline, json.loads(chat))
+
+class ConversationStore:
+	"""storage backend for conversation states, subclass it to keep them somewhere else"""
+
+	def get(self, chat_id: int) -> Optional[ConversationState]:
+		raise NotImplementedError
+
+	def put(self, state: ConversationState) -> None:
+		raise NotImplementedError
+
+	def delete(self, chat_id: int) -> None:
+		raise NotImplementedError
+
+	def pop_expired(self, now: float) -> List[ConversationState]:
+		"""removes and returns all states whose deadline has passed"""
+		raise NotImplementedError
+
+	def close(self) -> None:
+		pass
+
+class MemoryConversationStore(ConversationStore):
+	"""default backend, keeps the states in a dict, they are lost on restart"""
+
+	def __init__(self):
+		self.states: dict = dict()
+		# used from workers, the router and the timer thread
+		self._lock = threading.Lock()
+
+	def get(self, chat_id: int) -> Optional[ConversationState]:
+		with self._lock:
+			row = self.states.get(chat_id)
+		return ConversationState.from_row(row) if row else None
+
+	def put(self, state: ConversationState) -> None:
+		# stored as row so callers never share a mutable state object
+		row = state.to_row()
+		with self._lock:
+			self.states[state.chat_id] = row
+
+	def delete(self, chat_id: int) -> None:
+		with self._lock:
+			self.states.pop(chat_id, None)
+
+	def pop_expired(self, now: float) -> List[ConversationState]:
+		with self._lock:
+			expired = [chat_id for chat_id, row in self.states.items() if row[5] is not None and row[5] <= now]
+			return [ConversationState.from_row(self.states.pop(chat_id)) for chat_id in expired]
+
+class SQLiteConversationStore(ConversationStore):
+	"""one row per chat in a local SQLite database, states survive a restart
+
+	The ids of the chats with a state are read when the store is opened and kept in
+	memory, so only messages of those chats query the database. States that another
+	process writes afterwards aren't seen (ShardedRunner keeps a chat on one shard)."""
+
+	COLUMNS = "chat_id, dialogue, step, answers, prompt, deadline, chat"
+
+	def __init__(self, path: str="conversations.sqlite3"):
+		self.path: str = path
+		self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+		self._lock = threading.Lock()
+		with self._lock:
+			self.connection.execute("PRAGMA journal_mode=WAL")
+			self.connection.execute("PRAGMA synchronous=NORMAL")
+			self.connection.execute("CREATE TABLE IF NOT EXISTS conversations (chat_id INTEGER PRIMARY KEY, "
+				"dialogue TEXT NOT NULL, step TEXT, answers TEXT NOT NULL, prompt TEXT, deadline REAL, chat TEXT)")
+			self.connection.execute("CREATE INDEX IF NOT EXISTS conversations_deadline ON conversations (deadline)")
+			# chats with a state, every message of a chat is looked up, most of them have none
+			self._chat_ids: set = {row[0] for row in self.connection.execute("SELECT chat_id FROM conversations")}
+
+	def get(self, chat_id: int) -> Optional[ConversationState]:
+		with self._lock:
+			if chat_id not in self._chat_ids:
+				return None
+			row = self.connection.execute(f"SELECT {self.COLUMNS} FROM conversations WHERE chat_id = ?", (chat_id,)).fetchone()
+		return ConversationState.from_row(row) if row else None
+
+	def put(self, state: ConversationState) -> None:
+		with self._lock:
+			self.connection.execute(f"INSERT OR REPLACE INTO conversations ({self.COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)", state.to_row())
+			self._chat_ids.add(state.chat_id)
+
+	def delete(self, chat_id: int) -> None:
+		with self._lock:
+			if chat_id not in self._chat_ids:
+				return
+			self.connection.execute("DELETE FROM conversations WHERE chat_id = ?", (chat_id,))
+			self._chat_ids.discard(chat_id)
+
+	def pop_expired(self, now: float) -> List[ConversationState]:
+		with self._lock:
+			if not self._chat_ids:
+				return list()
+			# IMMEDIATE, so two processes sharing the database never both expire a state
+			self.connection.execute("BEGIN IMMEDIATE")
+			try:
+				rows = self.connection.execute(f"SELECT {self.COLUMNS} FROM conversations WHERE deadline <= ?", (now,)).fetchall()
+				self.connection.execute("DELETE FROM conversations WHERE deadline <= ?", (now,))
+				self.connection.execute("COMMIT")
+			except Exception:
+				self.connection.execute("ROLLBACK")
+				raise
+			self._chat_ids.difference_update(row[0] for row in rows)
+		return [ConversationState.from_row(row) for row in rows]
+
+	def close(self) -> None:
+		with self._lock:
+			self.connection.close()
+
+class DialogueStep:
+
+	def __init__(self, name: str, func, prompt: str=None, options: List[str]=None, columns: int=1):
+		self.name: str = name
+		self.func = func
+		self.prompt = prompt
+		self.options: List[str] = options
+		self.columns: int = columns
+
+class Dialogue:
+	"""multi-step conversation that doesn't park a thread while it waits for the user
+
+	Every step sends its prompt and stores the ConversationState. When the answer (a
+	Message, or a CallbackQuery for steps with options) arrives, the step function is
+	called with (chat, answers, answer), also after the bot was restarted. It returns
+	the name of the next step, or None to end the dialogue."""
+
+	def __init__(self, bot: "TelegramBot", name: str, timeout: float=None):
+		self.bot: TelegramBot = bot
+		self.name: str = name
+		self.timeout: float = timeout
+		self.steps: dict = dict()
+		self.first_step: str = None
+		self.timeout_handler = None
+		self._is_async: bool = inspect.iscoroutinefunction(bot.send_message)
+
+	def step(self, name: str, prompt: str=None, options: List[str]=None, columns: int=1):
+		"""prompt may also be a function that builds the prompt from the answers"""
+		def inner(func):
+			self.steps[name] = DialogueStep(name, func, prompt, options, columns)
+			if self.first_step is None:
+				self.first_step = name
+			return func
+		return inner
+
+	def on_timeout(self, func):
+		"""func(chat, answers) is called when the user didn't answer within timeout seconds"""
+		self.timeout_handler = func
+		return func
+
+	def start(self, chat_instance: ChatInstance, step: str=None, answers: dict=None) -> any:
+		"""starts the dialogue in the chat of chat_instance, has to be awaited on AsyncTelegramBot"""
+		chat = chat_instance.chat
+		state = ConversationState(chat.id, self.name, answers=answers, chat=chat.raw or chat.to_dict())
+		return self._goto(chat_instance, state, step or self.first_step)
+
+	def _goto(self, chat_instance: ChatInstance, state: ConversationState, step_name: str) -> any:
+		if step_name is None:
+			self.bot.conversations.delete(state.chat_id)
+			self.bot._schedule_conversation_timeout(state.chat_id, None)
+			return self._send_prompt(chat_instance, None, None)
+		if step_name not in self.steps:
+			self.bot.conversations.delete(state.chat_id)
+			self.bot._schedule_conversation_timeout(state.chat_id, None)
+			raise TeleasyError(f"Dialogue '{self.name}' has no step '{step_name}'")
+		step = self.steps[step_name]
+		state.step = step_name
+		state.prompt = step.prompt(state.answers) if callable(step.prompt) else step.prompt
+		state.deadline = time.time() + self.timeout if self.timeout else None
+		# stored before the prompt is sent, the answer may arrive right after it
+		self.bot.conversations.put(state)
+		self.bot._schedule_conversation_timeout(state.chat_id, self.timeout)
+		return self._send_prompt(chat_instance, step, state.prompt)
+
+	def _send_prompt(self, chat_instance: ChatInstance, step: DialogueStep, prompt: str) -> any:
+		if self._is_async:
+			return self._send_prompt_async(chat_instance, step, prompt)
+		if prompt:
+			self.bot.send_message(chat_instance.chat, prompt, **self._prompt_kwargs(step))
+
+	async def _send_prompt_async(self, chat_instance: ChatInstance, step: DialogueStep, prompt: str) -> None:
+		if prompt:
+			await self.bot.send_message(chat_instance.chat, prompt, **self._prompt_kwargs(step))
+
+	@staticmethod
+	def _prompt_kwargs(step: DialogueStep) -> dict:
+		if step.options:
+			return {"reply_markup": TeleasyUtils.make_easy_inlinekeyboard(step.options, step.columns, cache=True)}
+		return {"force_reply": True}
+
+	def _resume(self, chat_instance: ChatInstance, answer: Message or CallbackQuery) -> any:
+		# read again here: handlers of a chat run one after another, so this sees the
+		# step that a previous answer of the same chat has moved the dialogue to
+		state = self.bot.conversations.get(chat_instance.chat.id)
+		if state is None or state.dialogue != self.name:
+			return None
+		step = self.steps.get(state.step)
+		if step is None:
+			self.bot.conversations.delete(state.chat_id)
+			raise TeleasyError(f"Dialogue '{self.name}' has no step '{state.step}'")
+		next_step = step.func(chat_instance, state.answers, answer)
+		if inspect.isawaitable(next_step):
+			return self._resume_async(chat_instance, state, next_step)
+		return self._goto(chat_instance, state, next_step)
+
+	async def _resume_async(self, chat_instance: ChatInstance, state: ConversationState, next_step) -> None:
+		await self._goto(chat_instance, state, await next_step)
+
+	def _expire(self, chat_instance: ChatInstance, state: ConversationState) -> any:
+		if self.timeout_handler is None:
+			return None
+		result = self.timeout_handler(chat_instance, state.answers)
+		return result if inspect.isawaitable(result) else None
 
 class TelegramBot:
 
-	def __init__(self, token):
+	api_type = TelegramAPI
+	chat_instance_type = ChatInstance
+	timer_service_type = TimerService
+	# sent with every plain message, encoded only once
+	remove_keyboard = ReplyKeyboardRemove.make().freeze()
+
+	def __init__(self, token, pool_size: int=10, connect_timeout: float=5.0, read_timeout: float=30.0,
+			base_url: str=TelegramAPI.DEFAULT_BASE_URL):
 		self.config = TeleasyBotConfig()
-		self.api = TelegramAPI(token)
+		self.api = self.api_type(token, pool_size, connect_timeout, read_timeout, base_url)
 		self.handlers = HandlerList()
 		self.awaiting_answers = dict()
 		self.awaiting_callbacks = dict()
@@ -288,14 +1289,202 @@ class TelegramBot:
 		self.global_timeout_handler = None
 		self.global_unknown_command_handler = None
 		self.active_chats: List[int] = list()
+		# chat id -> number of queued or running handlers
+		self._chat_activations: dict = dict()
+		self._active_lock = threading.Lock()
+		self._dispatcher: Dispatcher = None
+		self._router: Dispatcher = None
+		self.webhook_server: WebhookServer = None
+		self.dialogues: dict = dict()
+		self._conversations: ConversationStore = None
+		self._next_conversation_sweep: float = 0.0
+		self._conversation_timers: dict = dict()
+		self._timers: TimerService = None
+		self.metrics_server: MetricsServer = None
+		self.profiler: HandlerProfiler = None
+		# records also go to this logger when it is enabled for their level
+		self.logger: logging.Logger = logging.getLogger("teleasy")
+		self._log_pipeline: LogPipeline = None
+		self._log_lock = threading.Lock()
+		self._register_metrics()
+
+	@property
+	def dispatcher(self) -> Dispatcher:
+		if self._dispatcher is None:
+			self._dispatcher = Dispatcher(self.config.max_workers, self.config.max_queue_size)
+			self._dispatcher.on_error = self._log_uncaught_error
+		return self._dispatcher
+
+	@property
+	def router(self) -> Dispatcher:
+		"""separate small pool for routing and callback answers: these never wait for
+		user input, so they can't be starved by handlers parked in chat.input()"""
+		if self._router is None:
+			self._router = Dispatcher(self.config.routing_workers, self.config.max_queue_size)
+			self._router.on_error = self._log_uncaught_error
+		return self._router
+
+	@property
+	def metrics(self) -> Optional[Metrics]:
+		"""shared with the api, None if bot.api.metrics was disabled"""
+		return self.api.metrics
+
+	def _register_metrics(self) -> None:
+		metrics = self.metrics
+		if metrics is None:
+			return
+		metrics.counter("teleasy_updates_total", "Received updates by type", ("type",))
+		metrics.counter("teleasy_handler_calls_total", "Finished handler runs", ("handler_type", "command"))
+		metrics.counter("teleasy_handler_errors_total", "Handler runs that raised", ("handler_type", "command"))
+		metrics.histogram("teleasy_handler_seconds", "Handler run time, including time waiting for user input",
+			("handler_type", "command"))
+		metrics.gauge("teleasy_handlers_in_flight", "Handlers currently running")
+		metrics.gauge("teleasy_active_chats", "Chats with a running handler", func=lambda: len(self.active_chats))
+		metrics.gauge("teleasy_awaiting_answers", "Handlers waiting in chat.input()", func=lambda: len(self.awaiting_answers))
+		metrics.gauge("teleasy_awaiting_callbacks", "Handlers waiting in chat.select()", func=lambda: len(self.awaiting_callbacks))
+		metrics.gauge("teleasy_dialogue_timers", "Dialogue steps waiting for an answer with a timeout",
+			func=lambda: len(self._conversation_timers))
+		metrics.gauge("teleasy_dispatcher_workers", "Handler worker threads",
+			func=lambda: self._dispatcher.num_workers if self._dispatcher else 0)
+		metrics.gauge("teleasy_dispatcher_pending", "Handler jobs waiting for a worker",
+			func=lambda: self._dispatcher.num_pending if self._dispatcher else 0)
+		metrics.gauge("teleasy_dispatcher_parked", "Handler jobs parked in chat.input() or chat.select()",
+			func=lambda: self._dispatcher.num_parked if self._dispatcher else 0)
+		metrics.gauge("teleasy_router_pending", "Update batches waiting to be routed",
+			func=lambda: self._router.num_pending if self._router else 0)
+		metrics.gauge("teleasy_log_records_dropped", "Console log records dropped because the log queue was full",
+			func=lambda: self._log_pipeline.dropped if self._log_pipeline else 0)
+
+	@staticmethod
+	def _handler_labels(handler: Handler) -> tuple:
+		return (handler.type.name.lower(), handler.command or "")
+
+	def _measure_handler(self, handler: Handler, func, *args) -> None:
+		if self.metrics is None and not self._log_enabled(logging.DEBUG):
+			return self._profile_handler(handler, func, *args)
+		self._handler_started()
+		started = time.perf_counter()
+		try:
+			self._profile_handler(handler, func, *args)
+		finally:
+			self._handler_finished(handler, args[0] if args else None, time.perf_counter() - started)
+
+	def _handler_started(self) -> None:
+		if self.metrics is not None:
+			self.metrics.inc("teleasy_handlers_in_flight")
+
+	def _handler_finished(self, handler: Handler, chat_instance: ChatInstance, seconds: float) -> None:
+		metrics = self.metrics
+		if metrics is not None:
+			labels = self._handler_labels(handler)
+			metrics.inc("teleasy_handlers_in_flight", value=-1)
+			metrics.inc("teleasy_handler_calls_total", *labels)
+			metrics.observe("teleasy_handler_seconds", seconds, *labels)
+		if chat_instance is not None and self._log_enabled(logging.DEBUG):
+			self._log_update(f"Handler {handler.name} finished in {seconds * 1000:.1f}ms in", "handler_finished",
+				chat_instance, handler, logging.DEBUG, latency=seconds)
+
+	def enable_profiling(self, commands: List[str]=None, sample_every: int=1, slow_threshold: float=1.0,
+			functions: bool=False) -> HandlerProfiler:
+		"""profiles the runs of the given commands (every handler if None), of those every sample_every-th.
+		Runs taking slow_threshold seconds or longer are logged with their profile. functions adds a
+		cProfile of sync handlers, which slows them down. Read the totals with bot.profiler.report()
+		or on /profile of the metrics server"""
+		self.profiler = HandlerProfiler(commands, sample_every, slow_threshold, functions)
+		return self.profiler
+
+	def disable_profiling(self) -> None:
+		self.profiler = None
+
+	def _profile_handler(self, handler: Handler, func, *args) -> None:
+		profiler = self.profiler
+		if profiler is None or not profiler.should_profile(handler):
+			return func(*args)
+		profile = HandlerProfile(profiler.name_of(handler))
+		token = current_profile.set(profile)
+		started, cpu_started = time.perf_counter(), time.thread_time()
+		try:
+			profiler.call(profile, func, *args)
+		finally:
+			profile.wall = time.perf_counter() - started
+			profile.cpu = time.thread_time() - cpu_started
+			current_profile.reset(token)
+			self._finish_profile(profiler, profile)
+
+	def _finish_profile(self, profiler: HandlerProfiler, profile: HandlerProfile) -> None:
+		if profiler.add(profile):
+			functions = ""
+			if profile.stats is not None:
+				out = io.StringIO()
+				profile.stats.stream = out
+				profile.stats.sort_stats("cumulative").print_stats(5)
+				functions = "\n" + out.getvalue()
+			self.log(f"[SLOW] {profile}{functions}", force_print=True, event="slow_handler", level=logging.WARNING,
+				handler=profile.name, latency=profile.wall, api_time=profile.api_time, wait_time=profile.wait_time)
+
+	@staticmethod
+	def _record_wait(started: float) -> None:
+		profile = current_profile.get()
+		if profile is not None:
+			profile.add_wait(time.perf_counter() - started)
+
+	def _count_handler_error(self, handler: Handler) -> None:
+		if self.metrics is not None:
+			self.metrics.inc("teleasy_handler_errors_total", *self._handler_labels(handler))
+
+	def _count_update(self, update_type: str) -> None:
+		if self.metrics is not None:
+			self.metrics.inc("teleasy_updates_total", update_type)
+
+	def start_metrics_server(self, port: int=9100, host: str="127.0.0.1", path: str="/metrics") -> MetricsServer:
+		"""serves bot.metrics for Prometheus, use bot.metrics.snapshot() to read them from Python"""
+		if self.metrics is None:
+			raise TeleasyError("metrics are disabled")
+		self.metrics_server = MetricsServer(self.metrics, host, port, path)
+		self.metrics_server.pages["/profile"] = lambda: self.profiler.report() if self.profiler else "profiling is disabled\n"
+		self.log(f"Started Metrics Server on {host}:{port}{path}", event="metrics_server_started")
+		return self.metrics_server
+
+	@property
+	def timers(self) -> TimerService:
+		"""owns every pending answer and dialogue timeout of the bot"""
+		if self._timers is None:
+			self._timers = self.timer_service_type()
+			self._timers.on_error = self._log_uncaught_error
+		return self._timers
+
+	@property
+	def conversations(self) -> ConversationStore:
+		if self._conversations is None:
+			store = self.config.conversation_store
+			if store is None:
+				store = MemoryConversationStore()
+			elif isinstance(store, str):
+				store = SQLiteConversationStore(store)
+			self._conversations = store
+		return self._conversations
+
+	def dialogue(self, name: str, timeout: float=None) -> Dialogue:
+		"""creates a Dialogue, name identifies it in the ConversationStore across restarts"""
+		new_dialogue = Dialogue(self, name, timeout)
+		self.dialogues[name] = new_dialogue
+		return new_dialogue
 
 	def activate_chat(self, chat_id: int) -> None:
-		if not chat_id in self.active_chats:
-			self.active_chats.append(chat_id)
+		"""counted: the chat stays active until every handler that activated it has finished"""
+		with self._active_lock:
+			count = self._chat_activations.get(chat_id, 0)
+			self._chat_activations[chat_id] = count + 1
+			if count == 0:
+				self.active_chats.append(chat_id)
 
 	def deactivate_chat(self, chat_id: int) -> None:
-		if chat_id in self.active_chats:
-			self.active_chats.remove(chat_id)
+		with self._active_lock:
+			count = self._chat_activations.pop(chat_id, 0) - 1
+			if count > 0:
+				self._chat_activations[chat_id] = count
+			elif chat_id in self.active_chats:
+				self.active_chats.remove(chat_id)
 
 	def on_error(self, func):
 		self.global_error_handler = func
@@ -339,15 +1528,59 @@ class TelegramBot:
 		new_handler = Handler(handler_type, func, command=command)
 		self.handlers.add(new_handler)
 
-	def log(self, message, force_print=False) -> None:
-		if not self.config.console_logging and not force_print:
+	def _log_enabled(self, level: int) -> bool:
+		return (self.config.console_logging and level >= self.config.logging_level) or self.logger.isEnabledFor(level)
+
+	@property
+	def log_pipeline(self) -> LogPipeline:
+		"""writes console log lines and hands records to bot.logger in the background,
+		started with the first line"""
+		with self._log_lock:
+			if self._log_pipeline is None:
+				handler = logging.StreamHandler(self.config.log_stream if self.config.log_stream is not None else sys.stdout)
+				handler.setFormatter(LogFormatter(self.config))
+				self._log_pipeline = LogPipeline(handler, self.config.log_queue_size, self.logger)
+			return self._log_pipeline
+
+	def close_logging(self) -> None:
+		"""writes the remaining log lines, logging starts again on the next line"""
+		with self._log_lock:
+			pipeline, self._log_pipeline = self._log_pipeline, None
+		if pipeline is not None:
+			pipeline.close()
+
+	def log(self, message, force_print=False, event: str=None, level: int=logging.INFO, exc_info: BaseException=None,
+			**fields) -> None:
+		"""logs message with event and fields as structured data (record.event, record.fields) on
+		bot.logger, and on the console with console_logging or force_print. Both happen in the
+		log pipeline thread, the caller only queues the line. exc_info adds the traceback"""
+		console = force_print or (self.config.console_logging and level >= self.config.logging_level)
+		forward = self.logger.isEnabledFor(level)
+		if not console and not forward:
+			return
+		sample_rate = self.config.log_sample_rates.get(event)
+		if sample_rate is not None and random.random() >= sample_rate:
 			return
+		# the record is built, formatted and handed to bot.logger by the pipeline thread
+		self.log_pipeline.put(level, message, {"event": event, "fields": fields, "sample_rate": sample_rate}, console, forward, exc_info)
 
-		time_str = datetime.datetime.now().strftime(self.config.logging_time_format)
-		print(f"{self.config.logging_prefix} {time_str} {message}")
+	def logerror(self, message, force_print=False, event: str="error", exc_info: BaseException=None, **fields) -> None:
+		self.log(message, force_print, event, logging.ERROR, exc_info, **fields)
 
-	def logerror(self, message, force_print=False) -> None:
-		self.log(f"[ERROR] {message}", force_print)
+	def _log_uncaught_error(self, error: Exception) -> None:
+		"""errors of handlers without an error handler, and of timer callbacks. Always shown
+		on the console, as the traceback used to be printed"""
+		self.logerror(f"Uncaught {type(error).__name__}: {error}", True, "uncaught_error", error)
+
+	def _log_update(self, text: str, event: str, chat_instance: ChatInstance, handler: Handler=None,
+			level: int=logging.INFO, **fields) -> None:
+		"""logs "<text> Chat#<id>" with the chat id, update id and handler as fields"""
+		if not self._log_enabled(level):
+			return
+		update = getattr(chat_instance, "_update", None)
+		self.log(f"{text} Chat#{chat_instance.chat.id}", event=event, level=level, chat_id=chat_instance.chat.id,
+			update_id=update.update_id if update is not None else None,
+			handler=handler.name if handler is not None else None, **fields)
 
 	def reply_to(self, reply_message: Message, text: str, **kwargs) -> Message:
 		return self.send_message(
@@ -355,62 +1588,174 @@ class TelegramBot:
 			text=text, reply_to_message_id=reply_message.get_id(), **kwargs
 		)
 
-	def _run_handler_func(self, func, chat_instance: ChatInstance, *args):
+	def _run_handler(self, handler: Handler, chat_instance: ChatInstance, *args, ordered: bool=True, block: bool=True) -> None:
+		handler.run(chat_instance, self, *args, ordered=ordered, block=block)
+
+	def _run_handler_func(self, func, chat_instance: ChatInstance, *args, ordered: bool=True, block: bool=True):
+		"""error and timeout callbacks pass ordered=False, they must not wait behind the chat's handler.
+		Timeout callbacks also pass block=False, the timer thread must never wait for the dispatcher"""
 		handler = Handler(HandlerType.NORMAL_MESSAGE, func)
-		handler.run(chat_instance, self, *args)
+		self._run_handler(handler, chat_instance, *args, ordered=ordered, block=block)
 
 	def update_command_list(self, exceptions=[]):
 		hs = [h for h in self.handlers.handlers if h.command and h.command not in exceptions]
 		self.api.set_my_commands([
 			BotCommand.make(h.command, h.func.__doc__ if h.func.__doc__ else h.command.capitalize())._export() for h in hs
 		])
-		self.log("Synchronized Command List with Telegram Server")
+		self.log("Synchronized Command List with Telegram Server", event="command_list_synchronized")
 
 	def send_message(self, chat: Chat, text: str, editable=False, force_reply=False, placeholder=None, **kwargs) -> Message:
-		if not kwargs and not editable and not force_reply: kwargs["reply_markup"] = ReplyKeyboardRemove.make()
+		if not kwargs and not editable and not force_reply: kwargs["reply_markup"] = self.remove_keyboard
 		if force_reply: kwargs["reply_markup"] = ForceReply.make(None, placeholder if placeholder else None)
 		msg = self.api.send_message(chat_id=chat.id, text=str(text), parse_mode=self.config.parse_mode, **kwargs)
+		if self.config.compact_messages: msg = msg.compact()
 		msg._bot_ref = self
-		self.log(f"Sent Message to Chat#{chat.id}")
+		self.log(f"Sent Message to Chat#{chat.id}", event="sent_message", chat_id=chat.id)
 		return msg
 
+	def broadcast(self, chat_ids: List[int], text: str, reply_markup: ApiObject=None, concurrency: int=8,
+			checkpoint: str=None, **kwargs) -> BroadcastResult:
+		"""sends text to every chat in chat_ids and returns a BroadcastResult
+
+		Messages are sent from `concurrency` threads over the pooled connections and
+		are paced by the api's rate limiter. Errors never stop the broadcast: 403
+		(blocked/deactivated) recipients are recorded as blocked, everything else as
+		failed. If checkpoint is a file path, every outcome is appended to it and
+		recipients already listed there are skipped, so an interrupted broadcast can
+		be resumed by calling broadcast again with the same checkpoint."""
+		result = self._read_broadcast_checkpoint(checkpoint)
+		reply_markup = self._broadcast_markup(reply_markup)
+		pending = iter([chat_id for chat_id in chat_ids if chat_id not in result.statuses])
+		lock = threading.Lock()
+		checkpoint_file = open(checkpoint, "a", encoding="utf-8") if checkpoint else None
+
+		def send_all():
+			while True:
+				with lock:
+					chat_id = next(pending, None)
+				if chat_id is None:
+					return
+				try:
+					self.api.send_message(chat_id=chat_id, text=str(text), parse_mode=self.config.parse_mode,
+						reply_markup=reply_markup, **kwargs)
+					status, error = BroadcastResult.DELIVERED, None
+				except Exception as e:
+					status, error = self._broadcast_failure(e)
+				with lock:
+					self._record_broadcast(result, checkpoint_file, chat_id, status, error)
+
+		start_time = time.perf_counter()
+		threads = [threading.Thread(target=send_all, daemon=True) for _ in range(concurrency)]
+		try:
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+		finally:
+			result.elapsed = time.perf_counter() - start_time
+			if checkpoint_file:
+				with lock:
+					checkpoint_file.close()
+				checkpoint_file = None
+		self.log(f"Broadcast finished: {result}", event="broadcast_finished")
+		return result
+
+	@staticmethod
+	def _read_broadcast_checkpoint(checkpoint: str=None) -> BroadcastResult:
+		"""delivered and blocked recipients of the checkpoint are skipped, failed ones are tried again"""
+		result = BroadcastResult()
+		if checkpoint and os.path.exists(checkpoint):
+			statuses = dict()
+			with open(checkpoint, "r", encoding="utf-8") as f:
+				for line in f:
+					if line.strip():
+						entry = json.loads(line)
+						statuses[entry["chat_id"]] = entry["status"]
+			result.statuses = {chat_id: status for chat_id, status in statuses.items() if status != BroadcastResult.FAILED}
+			result.skipped = len(result.statuses)
+		return result
+
+	@staticmethod
+	def _broadcast_markup(reply_markup: ApiObject=None) -> ApiObject:
+		if isinstance(reply_markup, ApiObject) and not reply_markup._frozen:
+			# the markup is the same for every recipient, encode it only once. A copy is
+			# frozen so the caller can still change their markup afterwards
+			reply_markup = copy.copy(reply_markup).freeze()
+		return reply_markup
+
+	@staticmethod
+	def _broadcast_failure(error: Exception) -> tuple:
+		if isinstance(error, TelegramAPIError) and error.error_code == 403:
+			return BroadcastResult.BLOCKED, str(error)
+		return BroadcastResult.FAILED, str(error)
+
+	@staticmethod
+	def _record_broadcast(result: BroadcastResult, checkpoint_file, chat_id: int, status: str, error: str=None) -> None:
+		result.statuses[chat_id] = status
+		if error:
+			result.errors[chat_id] = error
+		if checkpoint_file:
+			checkpoint_file.write(json.dumps({"chat_id": chat_id, "status": status}) + "\n")
+			checkpoint_file.flush()
+
+	def get_timeout(self, chat_instance: ChatInstance) -> tuple:
+		"""returns (seconds, callback) of the timeout that expires first, or (None, None)"""
+		timeouts = list()
+		if chat_instance.timeout_config["time"]:
+			timeouts.append((chat_instance.timeout_config["time"], chat_instance.timeout_config["callback"]))
+		if self.global_timeout_time:
+			timeouts.append((self.global_timeout_time, self.global_timeout_handler))
+		if not timeouts:
+			return None, None
+		return min(timeouts, key=lambda t: t[0])
+
+	def _await(self, waiters: dict, chat_instance: ChatInstance) -> any:
+		waiter = Waiter()
+		waiters[chat_instance.chat.id] = waiter
+		self._schedule_waiter_timeout(waiters, waiter, chat_instance)
+		started = time.perf_counter()
+		# the worker's pool slot is free for other chats while this one waits
+		parked = self.dispatcher.park()
+		try:
+			waiter.wait()
+			if waiter.timed_out:
+				raise StopEvent()
+		finally:
+			if parked:
+				self.dispatcher.unpark()
+			self._record_wait(started)
+			if waiters.get(chat_instance.chat.id) is waiter:
+				del waiters[chat_instance.chat.id]
+		return waiter.result
+
+	def _schedule_waiter_timeout(self, waiters: dict, waiter: Waiter, chat_instance: ChatInstance) -> None:
+		timeout_time, timeout_callback = self.get_timeout(chat_instance)
+		if timeout_time:
+			waiter.timer = self.timers.schedule(timeout_time, self._expire_waiter, waiters, waiter, chat_instance, timeout_callback)
+
+	def _expire_waiter(self, waiters: dict, waiter: Waiter, chat_instance: ChatInstance, timeout_callback) -> None:
+		if not waiter.expire():
+			return
+		if waiters.get(chat_instance.chat.id) is waiter:
+			waiters.pop(chat_instance.chat.id, None)
+		if timeout_callback:
+			self._run_handler_func(timeout_callback, chat_instance, ordered=False, block=False)
+
+	def _resolve(self, waiters: dict, chat_id: int, result: any) -> None:
+		waiter = waiters.pop(chat_id, None)
+		if waiter and waiter.resolve(result.compact() if self.config.compact_messages else result):
+			if waiter.timer is not None:
+				self.timers.cancel(waiter.timer)
+
 	def await_answer(self, chat_instance: ChatInstance, text: str, placeholder=None, **kwargs) -> Message:
 		if text: self.send_message(chat_instance.chat, text, force_reply=True, placeholder=placeholder, **kwargs)
-		self.awaiting_answers[chat_instance.chat.id] = None
-		start_time = time.time()
-		while self.awaiting_answers[chat_instance.chat.id] == None:
-			time.sleep(0.2)
-			if chat_instance.timeout_config["time"] and time.time() - start_time > chat_instance.timeout_config["time"]:
-				self._run_handler_func(chat_instance.timeout_config["callback"], chat_instance)
-				del self.awaiting_answers[chat_instance.chat.id]
-				raise StopEvent()
-			elif self.global_timeout_time and time.time() - start_time > self.global_timeout_time:
-				self._run_handler_func(self.global_timeout_handler, chat_instance)
-				del self.awaiting_answers[chat_instance.chat.id]
-				raise StopEvent()
-		result = self.awaiting_answers[chat_instance.chat.id]
-		del self.awaiting_answers[chat_instance.chat.id]
-		return result
+		return self._await(self.awaiting_answers, chat_instance)
 
 	def await_callback(self, chat_instance: ChatInstance) -> CallbackQuery:
-		self.awaiting_callbacks[chat_instance.chat.id] = None
-		start_time = time.time()
-		while self.awaiting_callbacks[chat_instance.chat.id] == None:
-			time.sleep(0.1)
-			if chat_instance.timeout_config["time"] and time.time() - start_time > chat_instance.timeout_config["time"]:
-				self._run_handler_func(chat_instance.timeout_config["callback"], chat_instance)
-				del self.awaiting_callbacks[chat_instance.chat.id]
-				raise StopEvent()
-			elif self.global_timeout_time and time.time() - start_time > self.global_timeout_time:
-				self._run_handler_func(self.global_timeout_handler, chat_instance)
-				del self.awaiting_callbacks[chat_instance.chat.id]
-				raise StopEvent()
-		result = self.awaiting_callbacks[chat_instance.chat.id]
-		del self.awaiting_callbacks[chat_instance.chat.id]
-		return result
+		return self._await(self.awaiting_callbacks, chat_instance)
 
 	def make_chat_instance(self, update: Update) -> ChatInstance:
-		chat_instance = ChatInstance()
+		chat_instance = self.chat_instance_type()
 		chat_instance.bot = self
 		chat_instance.api = self.api
 		chat_instance._update = update
@@ -424,57 +1769,183 @@ class TelegramBot:
 		if update.has(CallbackQuery):
 			chat_instance.chat = update.callback_query.message.chat
 			chat_instance.callback = update.callback_query
-		for key, value in chat_instance.chat.__dict__.items():
+			chat_instance.print = lambda text, **kwargs: self.send_message(chat_instance.chat, text, **kwargs)
+			chat_instance.write = chat_instance.print
+		for key, value in chat_instance.chat._fields().items():
+			chat_instance.__dict__[key] = value
+		return chat_instance
+
+	def make_stored_chat_instance(self, chat_data: dict) -> ChatInstance:
+		"""chat instance for a chat that is only known from a ConversationState, e.g. on timeouts"""
+		chat_instance = self.chat_instance_type()
+		chat_instance.bot = self
+		chat_instance.api = self.api
+		chat_instance.chat = Chat(chat_data)
+		chat_instance.print = lambda text, **kwargs: self.send_message(chat_instance.chat, text, **kwargs)
+		chat_instance.write = chat_instance.print
+		for key, value in chat_instance.chat._fields().items():
 			chat_instance.__dict__[key] = value
 		return chat_instance
 
+	def _resume_conversation(self, chat_instance: ChatInstance, answer: Message or CallbackQuery) -> bool:
+		"""runs the next step if the chat is in a dialogue, returns whether it was"""
+		if not self.dialogues:
+			return False
+		state = self.conversations.get(chat_instance.chat.id)
+		if state is None:
+			return False
+		dialogue = self.dialogues.get(state.dialogue)
+		if dialogue is None:
+			self.logerror(f"Dropped state of unknown Dialogue '{state.dialogue}' in Chat#{state.chat_id}", chat_id=state.chat_id)
+			self.conversations.delete(state.chat_id)
+			return False
+		if state.deadline is not None and state.deadline <= time.time():
+			self.conversations.delete(state.chat_id)
+			self._run_handler_func(dialogue._expire, chat_instance, state, ordered=False)
+			return False
+		self._log_update("Received Dialogue Answer in", "received_dialogue_answer", chat_instance)
+		self._run_handler_func(dialogue._resume, chat_instance, answer)
+		return True
+
+	def _schedule_conversation_timeout(self, chat_id: int, delay: float=None) -> None:
+		"""replaces the timer of the chat's dialogue step, None only cancels it"""
+		timer = self._conversation_timers.pop(chat_id, None)
+		if timer is not None:
+			self.timers.cancel(timer)
+		if delay is not None:
+			self._conversation_timers[chat_id] = self.timers.schedule(delay, self._conversation_timed_out, chat_id)
+
+	def _conversation_timed_out(self, chat_id: int) -> None:
+		"""runs on the timer thread, the sweep writes to the store and is left to a worker"""
+		self._conversation_timers.pop(chat_id, None)
+		self.dispatcher.submit(None, self.sweep_conversations, True, block=False)
+
+	def sweep_conversations(self, force: bool=False) -> None:
+		"""runs the timeout handlers of expired dialogues. Dialogue steps started by this process
+		have their own timer, the sweep from the update loop (at most once a second) picks up
+		the ones that were stored before a restart"""
+		if not self.dialogues:
+			return
+		now = time.time()
+		if now < self._next_conversation_sweep and not force:
+			return
+		self._next_conversation_sweep = now + 1.0
+		for state in self.conversations.pop_expired(now):
+			dialogue = self.dialogues.get(state.dialogue)
+			if dialogue:
+				self.log(f"Dialogue '{state.dialogue}' timed out in Chat#{state.chat_id}", event="dialogue_timed_out", chat_id=state.chat_id)
+				self._run_handler_func(dialogue._expire, self.make_stored_chat_instance(state.chat), state, ordered=False)
+
 	def process_message_update(self, update: Update):
 		message = update.message
 		chat_instance = self.make_chat_instance(update)
 		if message.chat.id in self.awaiting_answers.keys():
-			self.log(f"Received Answer in Chat#{chat_instance.chat.id}")
-			self.awaiting_answers[message.chat.id] = message
-		elif chat_instance.chat.id in self.active_chats:
-			if self.handlers.contains(HandlerType.IGNORED_MESSAGE):
-				self.log(f"Received Message in active Chat#{chat_instance.chat.id}")
-				self.handlers.get(HandlerType.IGNORED_MESSAGE).run(chat_instance, self)
+			self._log_update("Received Answer in", "received_answer", chat_instance)
+			self._resolve(self.awaiting_answers, message.chat.id, message)
+			return
+		if self._resume_conversation(chat_instance, message):
+			return
+		if chat_instance.chat.id in self.active_chats:
+			ignored_handler = self.handlers.get(HandlerType.IGNORED_MESSAGE)
+			if ignored_handler:
+				self._log_update("Received Message in active", "received_ignored_message", chat_instance, ignored_handler)
+				self._run_handler(ignored_handler, chat_instance)
 			else:
-				self.log(f"Ignoring Message in active Chat#{chat_instance.chat.id}")
-		elif message.is_command() and self.handlers.contains_command(message.extract_command(),
-		ignore_case=self.config.ignore_command_case):
-			self.log(f"Received Command in Chat#{chat_instance.chat.id}")
-			self.handlers.get_by_command(message.extract_command(),
-				ignore_case=self.config.ignore_command_case).run(chat_instance, self)
-		elif message.is_command() and self.global_unknown_command_handler:
-			self.log(f"Received Unknown Command in Chat#{chat_instance.chat.id}")
+				self._log_update("Ignoring Message in active", "ignored_message", chat_instance)
+			return
+		is_command = message.is_command()
+		command_handler = None
+		if is_command:
+			command_handler = self.handlers.get_by_command(message.extract_command(),
+				ignore_case=self.config.ignore_command_case)
+		if command_handler:
+			self._log_update("Received Command in", "received_command", chat_instance, command_handler)
+			self._run_handler(command_handler, chat_instance)
+		elif is_command and self.global_unknown_command_handler:
+			self._log_update("Received Unknown Command in", "received_unknown_command", chat_instance)
 			self._run_handler_func(self.global_unknown_command_handler, chat_instance, message.extract_command())
 		elif self.handlers.contains(HandlerType.NORMAL_MESSAGE):
-			self.log(f"Received Message in Chat#{chat_instance.chat.id}")
-			self.handlers.get(HandlerType.NORMAL_MESSAGE).run(chat_instance, self)
+			self._log_update("Received Message in", "received_message", chat_instance)
+			self._run_handler(self.handlers.get(HandlerType.NORMAL_MESSAGE), chat_instance)
 
 	def process_callback_query_update(self, update: Update):
 		chat_instance = self.make_chat_instance(update)
 		if chat_instance.chat.id in self.awaiting_callbacks.keys():
-			self.log(f"Received Callback-Query Answer in Chat#{chat_instance.chat.id}")
-			self.awaiting_callbacks[chat_instance.chat.id] = update.callback_query
+			self._log_update("Received Callback-Query Answer in", "received_callback_answer", chat_instance)
+			self._resolve(self.awaiting_callbacks, chat_instance.chat.id, update.callback_query)
+		elif self._resume_conversation(chat_instance, update.callback_query):
+			pass
 		elif chat_instance.chat.id in self.active_chats:
-			if self.handlers.contains(HandlerType.IGNORED_CALLBACK_QUERY):
-				self.log(f"Received Callback-Query in active Chat#{chat_instance.chat.id}")
-				self.handlers.get(HandlerType.IGNORED_CALLBACK_QUERY).run(chat_instance, self)
+			ignored_handler = self.handlers.get(HandlerType.IGNORED_CALLBACK_QUERY)
+			if ignored_handler:
+				self._log_update("Received Callback-Query in active", "received_ignored_callback_query", chat_instance, ignored_handler)
+				self._run_handler(ignored_handler, chat_instance)
 			else:
-				self.log(f"Ignoring Callback-Query in active Chat#{chat_instance.chat.id}")
-		elif self.handlers.contains(HandlerType.CALLBACK_QUERY):
-			self.log(f"Received Callback-Query in Chat#{chat_instance.chat.id}")
-			self.handlers.get(HandlerType.CALLBACK_QUERY).run(chat_instance, self)
-		self.api.answer_callback_query(update.callback_query.id)
+				self._log_update("Ignoring Callback-Query in active", "ignored_callback_query", chat_instance)
+		else:
+			callback_handler = self.handlers.get(HandlerType.CALLBACK_QUERY)
+			if callback_handler:
+				self._log_update("Received Callback-Query in", "received_callback_query", chat_instance, callback_handler)
+				self._run_handler(callback_handler, chat_instance)
+		self.answer_callback_query(update.callback_query.id)
+
+	def answer_callback_query(self, callback_query_id: str, **kwargs) -> None:
+		if self.config.routing_workers > 0:
+			self.router.submit(None, lambda: self.api.answer_callback_query(callback_query_id, **kwargs))
+		else:
+			self.api.answer_callback_query(callback_query_id, **kwargs)
+
+	def process_update(self, update: Update) -> None:
+		self.sweep_conversations()
+		if update.has(Message):
+			self._count_update("message")
+			self.process_message_update(update)
+		elif update.has(CallbackQuery):
+			self._count_update("callback_query")
+			self.process_callback_query_update(update)
+		else:
+			self._count_update("other")
 
 	def update(self) -> None:
-		updates = self.api.getUpdates()
+		updates = self.api.getUpdates(
+			timeout=self.config.polling_timeout,
+			limit=self.config.polling_limit,
+			allowed_updates=self.config.allowed_updates
+		)
+		self.sweep_conversations()
+		if self.config.routing_workers > 0:
+			self.dispatch_batch(updates)
+		else:
+			for update in updates:
+				self.process_update(update)
+
+	@staticmethod
+	def get_update_chat_id(update: Update) -> int or None:
+		"""chat id of an update, read from raw so nothing has to be parsed"""
+		raw = update.raw
+		if "message" in raw:
+			return raw["message"]["chat"]["id"]
+		if "callback_query" in raw and "message" in raw["callback_query"]:
+			return raw["callback_query"]["message"]["chat"]["id"]
+		return None
+
+	def dispatch_batch(self, updates: List[Update]) -> None:
+		"""groups a batch by chat and routes the chats in parallel on the router pool"""
+		by_chat = dict()
 		for update in updates:
-			if update.has(Message):
-				self.process_message_update(update)
-			elif update.has(CallbackQuery):
-				self.process_callback_query_update(update)
+			by_chat.setdefault(self.get_update_chat_id(update), list()).append(update)
+		for chat_id, chat_updates in by_chat.items():
+			self.router.submit(chat_id, self._process_updates, chat_updates)
+
+	def _process_updates(self, updates: List[Update]) -> None:
+		for update in updates:
+			try:
+				self.process_update(update)
+			except Exception as e:
+				if self.global_error_handler:
+					self._run_handler_func(self.global_error_handler, None, e)
+				else:
+					self.logerror(f"during routing: {e}", event="routing_error")
 
 	def log_feedback(self) -> None:
 		"""print some feedback on your current configuration"""
@@ -502,13 +1973,80 @@ class TelegramBot:
 		for case, message in test_cases:
 			if not case:
 				continue
-			self.log(f"[FEEDBACK] {message}", True)
+			self.log(f"[FEEDBACK] {message}", True, event="feedback")
 			feedbacks_given += 1
 		if feedbacks_given == 0:
-			self.log(f"[FEEDBACK] Everything seems good!")
+			self.log(f"[FEEDBACK] Everything seems good!", event="feedback")
+
+	def set_webhook(self, url: str, secret_token: str=None, drop_pending_updates: bool=None, **kwargs) -> None:
+		self.api.set_webhook(url, secret_token=secret_token, allowed_updates=self.config.allowed_updates,
+			drop_pending_updates=drop_pending_updates, **kwargs)
+		self.log(f"Registered Webhook {url}", event="webhook_registered")
+
+	def delete_webhook(self, drop_pending_updates: bool=None) -> None:
+		self.api.delete_webhook(drop_pending_updates=drop_pending_updates)
+		self.log("Deleted Webhook", event="webhook_deleted")
+
+	def _use_null_transport(self, transport_type: type) -> tuple:
+		"""returns the replaced transport and rate limiter for _restore_transport"""
+		saved = (self.api.transport, self.api.rate_limiter)
+		self.api.transport = transport_type()
+		# nothing is sent, pacing would only distort the replay
+		self.api.rate_limiter = None
+		return saved
+
+	def _restore_transport(self, saved: tuple) -> None:
+		self.api.transport, self.api.rate_limiter = saved
+
+	def _replay_delay(self, recorded_time: float, first_time: float, started: float, speed: float) -> float:
+		return (recorded_time - first_time) / speed - (time.monotonic() - started)
+
+	def replay(self, path: str, speed: float=None, null_transport: bool=True, wait_timeout: float=10.0) -> int:
+		"""feeds an UpdateJournal (see api.record_updates) through the bot and returns the number of updates
+
+		speed None replays as fast as possible, 1.0 with the recorded timing, 2.0 twice as fast.
+		With null_transport, outgoing calls go to a NullTransport until the replay returns, the
+		bot's own transport and rate limiter are restored then. Waits up to wait_timeout seconds
+		for routing and the handlers to finish, handlers parked in chat.input() may never do."""
+		saved = self._use_null_transport(NullTransport) if null_transport else None
+		count = 0
+		first_time = None
+		started = time.monotonic()
+		try:
+			for recorded_time, raw in UpdateJournal(path, self.api.codec):
+				if speed:
+					first_time = recorded_time if first_time is None else first_time
+					delay = self._replay_delay(recorded_time, first_time, started, speed)
+					if delay > 0:
+						time.sleep(delay)
+				self.process_update(Update(raw))
+				count += 1
+			# routing (and callback answers) first, it submits to the dispatcher
+			deadline = time.monotonic() + wait_timeout
+			self.router.join(wait_timeout)
+			self.dispatcher.join(max(0.0, deadline - time.monotonic()))
+		finally:
+			if saved is not None:
+				self._restore_transport(saved)
+		self.log(f"Replayed {count} Updates from {path} in {time.monotonic() - started:.2f}s", event="replay_finished")
+		return count
+
+	def start_webhook(self, url: str=None, host: str="0.0.0.0", port: int=8443, path: str="/", secret_token: str=None) -> None:
+		"""receive updates through a webhook instead of polling. If url is given, it is registered
+		with Telegram first; leave it out when the webhook is already set (e.g. behind a load balancer)"""
+		if url: self.set_webhook(url, secret_token=secret_token)
+		self.webhook_server = WebhookServer(self, host, port, path, secret_token)
+		self.log(f"Started Webhook Server on {host}:{port}{path}", event="webhook_server_started")
+		try:
+			self.webhook_server.serve_forever()
+		finally:
+			self.webhook_server.close()
+			self.api.close_transport()
+		self.log("Stopped Webhook Server", event="webhook_server_stopped")
+		self.close_logging()
 
 	def start(self, interval=0.0) -> None:
-		self.log("Started Polling Process")
+		self.log("Started Polling Process", event="polling_started")
 		while self.running:
 			try:
 				self.update()
@@ -516,8 +2054,524 @@ class TelegramBot:
 				if self.global_error_handler:
 					self._run_handler_func(self.global_error_handler, None, e)
 				else:
-					self.logerror(f"during polling: {e}")
+					self.logerror(f"during polling: {e}", event="polling_error")
 				time.sleep(1.)
 			if interval > 0:
 				time.sleep(interval)
-		self.log("Stopped Polling Process")
+		self.api.close_transport()
+		self.log("Stopped Polling Process", event="polling_stopped")
+		self.close_logging()
+
+class AsyncWaiter:
+	"""asyncio counterpart of Waiter, a parked dialogue only costs a future"""
+
+	def __init__(self):
+		self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+		self.timed_out: bool = False
+		self.timer: asyncio.TimerHandle = None
+
+	def resolve(self, result: any) -> bool:
+		if self.future.done():
+			return False
+		self.future.set_result(result)
+		return True
+
+	def expire(self) -> bool:
+		if self.future.done():
+			return False
+		self.timed_out = True
+		self.future.set_result(None)
+		return True
+
+	async def wait(self, timeout: float=None) -> bool:
+		try:
+			await asyncio.wait_for(asyncio.shield(self.future), timeout)
+			return True
+		except asyncio.TimeoutError:
+			return False
+
+	@property
+	def result(self) -> any:
+		return self.future.result()
+
+class AsyncTimerService:
+	"""TimerService interface on top of the timer heap of the running event loop"""
+
+	def schedule(self, delay: float, func, *args) -> asyncio.TimerHandle:
+		return asyncio.get_running_loop().call_later(delay, func, *args)
+
+	def cancel(self, timer: asyncio.TimerHandle) -> None:
+		timer.cancel()
+
+	def shutdown(self) -> None:
+		pass
+
+class AsyncChatInstance(ChatInstance):
+	"""ChatInstance handed to coroutine handlers: print, reply, input, select etc. must be awaited"""
+
+	async def wait(self, seconds: float):
+		"""same functionality as asyncio.sleep(*args)"""
+		await asyncio.sleep(seconds)
+
+	async def select(self, text: str, options: List[str], columns:int=1, callbacks: List[str]=None, disappering_buttons=True) -> str:
+		keyboard = TeleasyUtils.make_easy_inlinekeyboard(options, columns, callbacks, cache=True)
+		message = await self.bot.send_message(self.chat, text, reply_markup=keyboard)
+		try:
+			callback = (await self.bot.await_callback(self)).data
+		finally:
+			if disappering_buttons:
+				await message.edit_reply_keyboard(None)
+		return callback
+
+	async def input_keyboard(self, text: str, options: List[str], columns:int=1) -> Message:
+		keyboard = TeleasyUtils.make_easy_keyboard(options, columns, cache=True)
+		await self.bot.send_message(self.chat, text, reply_markup=keyboard)
+		return await self.bot.await_answer(self, None)
+
+class AsyncTelegramBot(TelegramBot):
+	"""asyncio engine: handlers are coroutines that run as tasks on a single event loop
+
+	Handlers are registered with the same decorators as on TelegramBot,
+	plain functions are accepted as well but will block the loop while they run."""
+
+	api_type = AsyncTelegramAPI
+	chat_instance_type = AsyncChatInstance
+	timer_service_type = AsyncTimerService
+
+	def __init__(self, token, pool_size: int=100, connect_timeout: float=5.0, read_timeout: float=30.0,
+			base_url: str=TelegramAPI.DEFAULT_BASE_URL):
+		super().__init__(token, pool_size, connect_timeout, read_timeout, base_url)
+		self._tasks = set()
+
+	def _spawn(self, coroutine) -> asyncio.Task:
+		# keep a reference, the loop only holds weak references to its tasks
+		task = asyncio.get_running_loop().create_task(coroutine)
+		self._tasks.add(task)
+		task.add_done_callback(self._tasks.discard)
+		return task
+
+	def _conversation_timed_out(self, chat_id: int) -> None:
+		# runs on the event loop, the handlers of the sweep are spawned there
+		self._conversation_timers.pop(chat_id, None)
+		self.sweep_conversations(force=True)
+
+	def _run_handler(self, handler: Handler, chat_instance: AsyncChatInstance, *args, ordered: bool=True, block: bool=True) -> None:
+		# marked before the task starts, later updates of the same batch have to see it
+		if chat_instance != None:
+			self.activate_chat(chat_instance.chat.id)
+		self._spawn(self._measure_handler_async(handler, self._run_handler_async(handler, chat_instance, *args), chat_instance))
+
+	async def _measure_handler_async(self, handler: Handler, coroutine, chat_instance: AsyncChatInstance=None) -> None:
+		if self.metrics is None and not self._log_enabled(logging.DEBUG):
+			return await self._profile_handler_async(handler, coroutine)
+		self._handler_started()
+		started = time.perf_counter()
+		try:
+			await self._profile_handler_async(handler, coroutine)
+		finally:
+			self._handler_finished(handler, chat_instance, time.perf_counter() - started)
+
+	async def _profile_handler_async(self, handler: Handler, coroutine) -> None:
+		# cpu time and cProfile are per thread, other tasks run in between, so only times are taken
+		profiler = self.profiler
+		if profiler is None or not profiler.should_profile(handler):
+			return await coroutine
+		profile = HandlerProfile(profiler.name_of(handler))
+		# the task has its own context, the coroutine sees the profile when awaited here
+		token = current_profile.set(profile)
+		started = time.perf_counter()
+		try:
+			await coroutine
+		finally:
+			profile.wall = time.perf_counter() - started
+			current_profile.reset(token)
+			self._finish_profile(profiler, profile)
+
+	async def _run_handler_async(self, handler: Handler, chat_instance: AsyncChatInstance, *args) -> None:
+		try:
+			if chat_instance == None:
+				return_val = handler.func(None, *args)
+				if inspect.isawaitable(return_val):
+					await return_val
+				return
+			return_val = handler.func(chat_instance, *args)
+			if inspect.isawaitable(return_val):
+				return_val = await return_val
+			if isinstance(return_val, str) and chat_instance._update.has(Message) and return_val:
+				await self.send_message(chat_instance.chat, str(return_val))
+		except StopEvent:
+			pass
+		except Exception as error:
+			self._count_handler_error(handler)
+			if chat_instance != None and chat_instance._on_error:
+				self._run_handler_func(chat_instance._on_error, chat_instance, error, ordered=False)
+			elif self.global_error_handler:
+				self._run_handler_func(self.global_error_handler, chat_instance, error, ordered=False)
+			else:
+				self._log_uncaught_error(error)
+		finally:
+			if chat_instance != None:
+				self.deactivate_chat(chat_instance.chat.id)
+
+	async def update_command_list(self, exceptions=[]):
+		hs = [h for h in self.handlers.handlers if h.command and h.command not in exceptions]
+		await self.api.set_my_commands([
+			BotCommand.make(h.command, h.func.__doc__ if h.func.__doc__ else h.command.capitalize())._export() for h in hs
+		])
+		self.log("Synchronized Command List with Telegram Server", event="command_list_synchronized")
+
+	async def broadcast(self, chat_ids: List[int], text: str, reply_markup: ApiObject=None, concurrency: int=8,
+			checkpoint: str=None, **kwargs) -> BroadcastResult:
+		"""asyncio counterpart of TelegramBot.broadcast, concurrency is the number of sending tasks"""
+		result = self._read_broadcast_checkpoint(checkpoint)
+		reply_markup = self._broadcast_markup(reply_markup)
+		pending = iter([chat_id for chat_id in chat_ids if chat_id not in result.statuses])
+		checkpoint_file = open(checkpoint, "a", encoding="utf-8") if checkpoint else None
+
+		async def send_all():
+			# no lock needed, tasks only switch at await
+			for chat_id in pending:
+				try:
+					await self.api.send_message(chat_id=chat_id, text=str(text), parse_mode=self.config.parse_mode,
+						reply_markup=reply_markup, **kwargs)
+					status, error = BroadcastResult.DELIVERED, None
+				except Exception as e:
+					status, error = self._broadcast_failure(e)
+				self._record_broadcast(result, checkpoint_file, chat_id, status, error)
+
+		start_time = time.perf_counter()
+		try:
+			await asyncio.gather(*[send_all() for _ in range(concurrency)])
+		finally:
+			result.elapsed = time.perf_counter() - start_time
+			if checkpoint_file:
+				checkpoint_file.close()
+		self.log(f"Broadcast finished: {result}", event="broadcast_finished")
+		return result
+
+	async def send_message(self, chat: Chat, text: str, editable=False, force_reply=False, placeholder=None, **kwargs) -> Message:
+		if not kwargs and not editable and not force_reply: kwargs["reply_markup"] = self.remove_keyboard
+		if force_reply: kwargs["reply_markup"] = ForceReply.make(None, placeholder if placeholder else None)
+		msg = await self.api.send_message(chat_id=chat.id, text=str(text), parse_mode=self.config.parse_mode, **kwargs)
+		if self.config.compact_messages: msg = msg.compact()
+		msg._bot_ref = self
+		self.log(f"Sent Message to Chat#{chat.id}", event="sent_message", chat_id=chat.id)
+		return msg
+
+	async def _await(self, waiters: dict, chat_instance: AsyncChatInstance) -> any:
+		waiter = AsyncWaiter()
+		waiters[chat_instance.chat.id] = waiter
+		self._schedule_waiter_timeout(waiters, waiter, chat_instance)
+		started = time.perf_counter()
+		try:
+			await waiter.wait()
+			if waiter.timed_out:
+				raise StopEvent()
+		finally:
+			self._record_wait(started)
+			if waiters.get(chat_instance.chat.id) is waiter:
+				del waiters[chat_instance.chat.id]
+		return waiter.result
+
+	async def await_answer(self, chat_instance: AsyncChatInstance, text: str, placeholder=None, **kwargs) -> Message:
+		if text: await self.send_message(chat_instance.chat, text, force_reply=True, placeholder=placeholder, **kwargs)
+		return await self._await(self.awaiting_answers, chat_instance)
+
+	async def await_callback(self, chat_instance: AsyncChatInstance) -> CallbackQuery:
+		return await self._await(self.awaiting_callbacks, chat_instance)
+
+	def answer_callback_query(self, callback_query_id: str, **kwargs) -> None:
+		self._spawn(self.api.answer_callback_query(callback_query_id, **kwargs))
+
+	async def update(self) -> None:
+		updates = await self.api.getUpdates(
+			timeout=self.config.polling_timeout,
+			limit=self.config.polling_limit,
+			allowed_updates=self.config.allowed_updates
+		)
+		self.sweep_conversations()
+		for update in updates:
+			self.process_update(update)
+
+	async def run_polling(self, interval=0.0) -> None:
+		"""polling loop as a coroutine, for bots that share their event loop with other code"""
+		self.log("Started Polling Process", event="polling_started")
+		try:
+			while self.running:
+				try:
+					await self.update()
+				except Exception as e:
+					if self.global_error_handler:
+						self._run_handler_func(self.global_error_handler, None, e)
+					else:
+						self.logerror(f"during polling: {e}", event="polling_error")
+					await asyncio.sleep(1.)
+				if interval > 0:
+					await asyncio.sleep(interval)
+		finally:
+			await self.api.close_transport()
+		self.log("Stopped Polling Process", event="polling_stopped")
+		self.close_logging()
+
+	def start_webhook(self, *args, **kwargs) -> None:
+		raise TeleasyError("webhooks are not supported by the asyncio engine yet, use start() instead")
+
+	async def replay(self, path: str, speed: float=None, null_transport: bool=True, wait_timeout: float=10.0) -> int:
+		"""asyncio counterpart of TelegramBot.replay, has to run inside the event loop"""
+		saved = self._use_null_transport(AsyncNullTransport) if null_transport else None
+		count = 0
+		first_time = None
+		started = time.monotonic()
+		try:
+			for recorded_time, raw in UpdateJournal(path, self.api.codec):
+				if speed:
+					first_time = recorded_time if first_time is None else first_time
+					delay = self._replay_delay(recorded_time, first_time, started, speed)
+					if delay > 0:
+						await asyncio.sleep(delay)
+				self.process_update(Update(raw))
+				count += 1
+				# let the spawned handlers run, as they would between two polls
+				await asyncio.sleep(0)
+			if self._tasks:
+				await asyncio.wait(set(self._tasks), timeout=wait_timeout)
+		finally:
+			if saved is not None:
+				self._restore_transport(saved)
+		self.log(f"Replayed {count} Updates from {path} in {time.monotonic() - started:.2f}s", event="replay_finished")
+		return count
+
+	def start(self, interval=0.0) -> None:
+		asyncio.run(self.run_polling(interval))
+
+def _run_shard(bot_factory, shard: int, num_shards: int, inbox, heartbeat, health_interval: float, shutdown_timeout: float) -> None:
+	"""main loop of a ShardedRunner worker process"""
+	# Ctrl+C reaches the whole process group, the runner stops its shards itself
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	bot = bot_factory()
+	limiter = bot.api.rate_limiter
+	if limiter is not None and num_shards > 1:
+		# chats stay on one shard, but the global limit is shared by all of them
+		bot.api.rate_limiter = RateLimiter(limiter.global_rate / num_shards, limiter.chat_rate, limiter.group_rate, limiter.chat_burst)
+	bot.log(f"Started Shard {shard} (pid {os.getpid()})", event="shard_started", shard=shard)
+	def beat():
+		heartbeat.value = time.time()
+	# dispatching waits while the worker queue is full, that counts as progress as long
+	# as jobs keep finishing. A deadlocked loop or worker pool stops the heartbeat
+	bot.dispatcher.on_progress = beat
+	if bot.config.routing_workers > 0:
+		bot.router.on_progress = beat
+	while True:
+		beat()
+		try:
+			batch = inbox.get(timeout=health_interval)
+		except queue.Empty:
+			bot.sweep_conversations()
+			continue
+		if batch is None:
+			break
+		updates = [Update(raw) for raw in batch]
+		bot.sweep_conversations()
+		if bot.config.routing_workers > 0:
+			bot.dispatch_batch(updates)
+		else:
+			bot._process_updates(updates)
+	bot.router.join(shutdown_timeout)
+	bot.dispatcher.join(shutdown_timeout)
+	bot.api.close_transport()
+	bot.log(f"Stopped Shard {shard}", event="shard_stopped", shard=shard)
+	bot.close_logging()
+
+class ShardedRunner:
+	"""runs a TelegramBot in num_shards worker processes, to use more than one core for handlers
+
+	A single poller (or webhook receiver) in this process partitions the updates by chat id,
+	so a chat is always handled by the same shard and its in-memory state (chat.input(),
+	active chats) stays local to that process. Dialogues with a SQLite store (see
+	set_conversation_store) survive a restarted shard. bot_factory builds the bot with its handlers, it is called once here for
+	the polling config and once in every shard. With the spawn start method it has to be a
+	module-level function.
+
+	Every shard reports a heartbeat from its main loop, and while it waits for space in its
+	worker queue whenever a job finishes. A shard that died or hasn't reported for
+	health_timeout seconds (its loop or worker pool is stuck, or the process hangs) is
+	replaced by a new process. Updates queued for it and the chat.input() calls it
+	was waiting in are lost."""
+
+	def __init__(self, bot_factory, num_shards: int=None, health_interval: float=1.0, health_timeout: float=30.0,
+			max_queue_size: int=100, shutdown_timeout: float=5.0, start_method: str=None):
+		self.bot_factory = bot_factory
+		self.num_shards: int = num_shards or os.cpu_count() or 1
+		self.health_interval: float = health_interval
+		self.health_timeout: float = health_timeout
+		# batches per shard, the poller waits when a shard falls behind
+		self.max_queue_size: int = max_queue_size
+		self.shutdown_timeout: float = shutdown_timeout
+		self.context = multiprocessing.get_context(start_method)
+		self.bot: TelegramBot = bot_factory()
+		self.running: bool = True
+		self.processes: list = [None] * self.num_shards
+		self.inboxes: list = [None] * self.num_shards
+		self.heartbeats: list = [None] * self.num_shards
+		self.restarts: List[int] = [0] * self.num_shards
+		self.webhook_server: WebhookServer = None
+		self._lock = threading.Lock()
+		self._monitor: threading.Thread = None
+		self._next_shard = itertools.count()
+
+	def shard_of(self, update: Update) -> int:
+		"""updates without a chat (inline queries, polls, ...) are spread round-robin"""
+		chat_id = TelegramBot.get_update_chat_id(update)
+		if isinstance(chat_id, int):
+			return chat_id % self.num_shards
+		if chat_id is not None:
+			# str hashes differ between runs, crc32 keeps "@channel" ids on a fixed shard
+			return zlib.crc32(str(chat_id).encode("utf-8")) % self.num_shards
+		return next(self._next_shard) % self.num_shards
+
+	def _spawn(self, shard: int) -> None:
+		# a fresh queue every time: a process killed inside get() never releases the queue's lock
+		inbox = self.context.Queue(self.max_queue_size)
+		heartbeat = self.context.Value("d", time.time(), lock=False)
+		process = self.context.Process(target=_run_shard, name=f"teleasy-shard-{shard}", daemon=True,
+			args=(self.bot_factory, shard, self.num_shards, inbox, heartbeat, self.health_interval, self.shutdown_timeout))
+		process.start()
+		self.processes[shard], self.inboxes[shard], self.heartbeats[shard] = process, inbox, heartbeat
+
+	def _respawn(self, shard: int, reason: str) -> None:
+		with self._lock:
+			process, inbox = self.processes[shard], self.inboxes[shard]
+			if process.is_alive():
+				# SIGTERM would wait in a stopped or deadlocked process
+				process.kill()
+			process.join()
+			try:
+				lost = inbox.qsize()
+			except NotImplementedError:
+				lost = "unknown"
+			inbox.cancel_join_thread()
+			inbox.close()
+			self.restarts[shard] += 1
+			self.bot.logerror(f"Shard {shard} {reason}, restarting it ({lost} queued batches lost)",
+				event="shard_restarted", shard=shard, exitcode=process.exitcode)
+			self._spawn(shard)
+
+	def check_health(self) -> None:
+		for shard in range(self.num_shards):
+			process = self.processes[shard]
+			if process is None:
+				continue
+			if not process.is_alive():
+				self._respawn(shard, f"exited with code {process.exitcode}")
+			elif time.time() - self.heartbeats[shard].value > self.health_timeout:
+				self._respawn(shard, f"has not reported for {self.health_timeout:.0f}s")
+
+	def health(self) -> List[dict]:
+		now = time.time()
+		return [{"shard": shard, "pid": process.pid, "alive": process.is_alive(),
+			"heartbeat_age": now - self.heartbeats[shard].value, "restarts": self.restarts[shard]}
+			for shard, process in enumerate(self.processes) if process is not None]
+
+	def _watch(self) -> None:
+		while self.running:
+			time.sleep(self.health_interval)
+			if self.running:
+				try:
+					self.check_health()
+				except Exception as e:
+					self.bot.logerror(f"during health check: {e}", event="health_check_error")
+
+	def start_shards(self) -> None:
+		"""starts the shard processes and their health checks, start() and start_webhook() call this"""
+		self.running = True
+		for shard in range(self.num_shards):
+			if self.processes[shard] is None or not self.processes[shard].is_alive():
+				self._spawn(shard)
+		if self._monitor is None or not self._monitor.is_alive():
+			self._monitor = threading.Thread(target=self._watch, name="teleasy-shard-monitor", daemon=True)
+			self._monitor.start()
+		self.bot.log(f"Started {self.num_shards} Shards", event="shards_started", shards=self.num_shards)
+
+	def dispatch(self, updates: List[Update]) -> None:
+		by_shard = dict()
+		for update in updates:
+			by_shard.setdefault(self.shard_of(update), list()).append(update.raw)
+		for shard, batch in by_shard.items():
+			self._put(shard, batch)
+
+	def _put(self, shard: int, batch: list) -> None:
+		while self.running:
+			try:
+				# read on every try, the shard may have been replaced in between
+				self.inboxes[shard].put(batch, timeout=self.health_interval)
+				return
+			except (queue.Full, ValueError):
+				# ValueError: the queue was closed by a concurrent restart
+				continue
+
+	def process_update(self, update: Update) -> None:
+		"""lets WebhookServer feed the runner like a bot"""
+		self.dispatch([update])
+
+	def logerror(self, message, force_print=False, **fields) -> None:
+		self.bot.logerror(message, force_print, **fields)
+
+	def stop(self) -> None:
+		"""lets every shard finish its queued updates (up to shutdown_timeout for the handlers)"""
+		self.running = False
+		for shard, process in enumerate(self.processes):
+			if process is not None and process.is_alive():
+				try:
+					self.inboxes[shard].put(None, timeout=self.shutdown_timeout)
+				except queue.Full:
+					process.terminate()
+		for shard, process in enumerate(self.processes):
+			if process is None:
+				continue
+			# the shard waits shutdown_timeout for the router and then for the handlers
+			process.join(self.shutdown_timeout * 2 + self.health_interval)
+			if process.is_alive():
+				process.terminate()
+				process.join()
+			self.processes[shard] = None
+		self.bot.log("Stopped Shards", event="shards_stopped")
+
+	def start(self, interval=0.0) -> None:
+		bot = self.bot
+		self.start_shards()
+		bot.log("Started Polling Process", event="polling_started")
+		try:
+			while self.running:
+				try:
+					updates = bot.api.getUpdates(
+						timeout=bot.config.polling_timeout,
+						limit=bot.config.polling_limit,
+						allowed_updates=bot.config.allowed_updates
+					)
+					self.dispatch(updates)
+				except Exception as e:
+					bot.logerror(f"during polling: {e}", event="polling_error")
+					time.sleep(1.)
+				if interval > 0:
+					time.sleep(interval)
+		finally:
+			self.stop()
+			bot.api.close_transport()
+		bot.log("Stopped Polling Process", event="polling_stopped")
+		bot.close_logging()
+
+	def start_webhook(self, url: str=None, host: str="0.0.0.0", port: int=8443, path: str="/", secret_token: str=None) -> None:
+		"""like TelegramBot.start_webhook, the receiver partitions the updates onto the shards"""
+		bot = self.bot
+		if url: bot.set_webhook(url, secret_token=secret_token)
+		self.start_shards()
+		self.webhook_server = WebhookServer(self, host, port, path, secret_token)
+		bot.log(f"Started Webhook Server on {host}:{port}{path}", event="webhook_server_started")
+		try:
+			self.webhook_server.serve_forever()
+		finally:
+			self.webhook_server.close()
+			self.stop()
+			bot.api.close_transport()
+		bot.log("Stopped Webhook Server", event="webhook_server_stopped")
+		bot.close_logging()
@@ -1,8 +1,96 @@
-import json, requests, copy, time
+import json, requests, time, asyncio, threading, os, stat, mmap, uuid, shutil, hashlib, bisect, gzip, itertools, collections, contextvars
+from requests.adapters import HTTPAdapter
 from typing import Optional, List
 
+try:
+	import aiohttp
+except ImportError:
+	aiohttp = None
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+try:
+	import ujson
+except ImportError:
+	ujson = None
+
+class LazyField:
+	"""optional sub-object of an ApiObject, built from raw on first access
+
+	The built value is stored in the instance __dict__, which shadows the
+	field from then on, so later accesses cost a plain attribute lookup."""
+
+	def __init__(self, O: type or str, key: str=None, array: bool=False):
+		self.O: type or str = O
+		self.key: str = key
+		self.array: bool = array
+
+	def __set_name__(self, owner: type, name: str) -> None:
+		self.name = name
+		if self.key is None:
+			self.key = name
+
+	@property
+	def type(self) -> type:
+		# classes may be given by name to allow forward references
+		if isinstance(self.O, str):
+			self.O = globals()[self.O]
+		return self.O
+
+	def __get__(self, instance: "ApiObject", owner: type=None) -> any:
+		if instance is None:
+			return self
+		if self.array:
+			value = [self.type(v) for v in instance.raw.get(self.key, list())]
+		else:
+			value = self.type(instance.raw[self.key]) if self.key in instance.raw else None
+		instance.__dict__[self.name] = value
+		return value
+
 class ApiObject:
 
+	_lazy_fields: dict = dict()
+	_compact: bool = False
+	_frozen: bool = False
+	_encoded: tuple = None
+
+	def __init_subclass__(cls, **kwargs):
+		super().__init_subclass__(**kwargs)
+		cls._lazy_fields = {**cls._lazy_fields, **{k: v for k, v in cls.__dict__.items() if isinstance(v, LazyField)}}
+
+	def _materialize(self) -> None:
+		"""builds all lazy fields that have not been accessed yet"""
+		for name in self._lazy_fields:
+			if name not in self.__dict__:
+				getattr(self, name)
+
+	def _fields(self) -> dict:
+		"""attribute name -> value, independent of __dict__ or __slots__ storage"""
+		if self._compact:
+			return {name: getattr(self, name) for name in type(self)._field_names}
+		return self.__dict__
+
+	def compact(self, drop_raw: bool=True) -> "ApiObject":
+		"""returns a __slots__ based copy of this object (and all its sub-objects), see compact_type
+
+		isinstance checks and methods keep working on the copy. With drop_raw, the raw
+		dict is released and raw is set to None. Objects built with make() have no raw."""
+		if self._compact:
+			return self
+		self._materialize()
+		fields = tuple(k for k in self.__dict__ if k != "self")
+		compact_obj = object.__new__(compact_type(type(self), fields))
+		for key in fields:
+			setattr(compact_obj, key, _compact_value(self.__dict__[key], drop_raw))
+		if drop_raw and "raw" in fields:
+			compact_obj.raw = None
+		compact_obj._frozen = self._frozen
+		compact_obj._encoded = self._encoded
+		return compact_obj
+
 	def _get_array_of(self, O: any, parameter_name: str) -> None:
 		self.__dict__[parameter_name] = list()
 		if parameter_name in self.raw:
@@ -17,28 +105,25 @@ class ApiObject:
 		return bool(parameter_name in self.raw)
 
 	def to_dict(self, add_none=False) -> dict:
-		out_dict = copy.deepcopy(self.__dict__)
-		for key, val in out_dict.items():
-			if isinstance(val, ApiObject):
-				out_dict[key] = val.to_dict(add_none)
-			if isinstance(val, list):
-				temp_list = list()
-				for sub_val in val:
-					if isinstance(sub_val, ApiObject):
-						temp_list.append(sub_val.to_dict(add_none))
-					elif isinstance(sub_val, list):
-						temp_temp_list = list()
-						for sub_sub_val in sub_val:
-							if isinstance(sub_sub_val, ApiObject):
-								temp_temp_list.append(sub_sub_val.to_dict(add_none))
-							else:
-								temp_temp_list.append(sub_sub_val)
-						temp_list.append(temp_temp_list)
-					else:
-						temp_list.append(sub_val)
-				out_dict[key] = temp_list
-		return {k if k != "from_" else "from": v for k, v in out_dict.items()
-												 if (v != None or add_none) and not k in ["raw", "self", "__bot_ref"]}
+		"""walks the object without copying it, only the containers are rebuilt"""
+		self._materialize()
+		return {k if k != "from_" else "from": _serialize(v, add_none) for k, v in self._fields().items()
+				if (v != None or add_none) and not k in ["raw", "self"] and not k.startswith("_")}
+
+	def freeze(self) -> "ApiObject":
+		"""marks the object as immutable, its encoded JSON is then cached on first use.
+		A frozen object must not be modified anymore"""
+		self._frozen = True
+		return self
+
+	def _encode(self, codec: "JSONCodec") -> bytes:
+		if not self._frozen:
+			return codec.dumps(self._export())
+		cached = self._encoded
+		if cached is None or cached[0] != codec.backend:
+			cached = (codec.backend, codec.dumps(self._export()))
+			self._encoded = cached
+		return cached[1]
 
 	def __str__(self) -> str:
 		temp_out = f"<teleasy.{type(self).__name__}"
@@ -49,21 +134,30 @@ class ApiObject:
 
 	def __getitem__(self, key, soft=False, replacement=None) -> any:
 		if key == "from": key = "from_"
-		if key in self.__dict__:
-			return self.__dict__[key]
+		if key in self._lazy_fields: getattr(self, key)
+		fields = self._fields()
+		if key in fields:
+			return fields[key]
 		if soft: return replacement
 		raise AttributeError(f"{type(self).__name__} has no '{key}' attribute")
 
 	def has_type(self, search_type: type) -> bool:
-		for key, val in self.__dict__.items():
+		for key, val in self._fields().items():
 			if isinstance(val, search_type):
 				return True
+		# unbuilt lazy fields can be answered from raw without building them
+		for name, field in self._lazy_fields.items():
+			if name not in self.__dict__ and not field.array and field.key in self.raw \
+			and issubclass(field.type, search_type):
+				return True
 		return False
 
 	def has(self, key: type or str, strict=False) -> bool:
 		if type(key) == type: return self.has_type(key)
-		has_out = bool((key if key != "from_" or strict else "from") in self.__dict__)
-		if has_out is True: return self.__dict__[key] != None
+		if key in self._lazy_fields: getattr(self, key)
+		fields = self._fields()
+		has_out = bool((key if key != "from_" or strict else "from") in fields)
+		if has_out is True: return fields[key] != None
 		return False
 
 	@classmethod
@@ -74,7 +168,7 @@ class ApiObject:
 		return self.__getitem__(key, True, replacement)
 
 	def get_id(self) -> int or str or None:
-		for key, val in self.__dict__.items():
+		for key, val in self._fields().items():
 			if key.endswith("id"):
 				return val
 		return None
@@ -82,6 +176,41 @@ class ApiObject:
 	def _export(self) -> dict:
 		return self.to_dict()
 
+def _serialize(value: any, add_none: bool) -> any:
+	if isinstance(value, ApiObject):
+		return value.to_dict(add_none)
+	if isinstance(value, list):
+		return [_serialize(v, add_none) for v in value]
+	return value
+
+_compact_types = dict()
+
+def compact_type(cls: type, fields: tuple) -> type:
+	"""class with __slots__ for exactly the given fields and no __dict__ (cached per field set)
+
+	A subclass of cls would inherit its __dict__, so the compact class gets a copy of the
+	methods and class attributes of cls instead. It reports cls as its __class__, which
+	isinstance() and super() fall back to."""
+	key = (cls, fields)
+	if key not in _compact_types:
+		slots = fields + ("_frozen", "_encoded")
+		namespace = dict()
+		for base in reversed(cls.__mro__[:-1]):
+			namespace.update((name, value) for name, value in base.__dict__.items() if not isinstance(value, LazyField))
+		for name in ("__dict__", "__weakref__", "__init__", "__init_subclass__") + slots:
+			namespace.pop(name, None)
+		namespace.update(__slots__=slots, __class__=property(lambda self: cls),
+			_compact=True, _field_names=fields, _lazy_fields=dict())
+		_compact_types[key] = type(f"Compact{cls.__name__}", (), namespace)
+	return _compact_types[key]
+
+def _compact_value(value: any, drop_raw: bool) -> any:
+	if isinstance(value, ApiObject):
+		return value.compact(drop_raw)
+	if isinstance(value, list):
+		return [_compact_value(v, drop_raw) for v in value]
+	return value
+
 class LoginUrl(ApiObject):
 
 	def __init__(self, data):
@@ -811,6 +940,9 @@ class ReplyKeyboardMarkup(ApiObject):
 
 class CallbackQuery(ApiObject):
 
+	# optional sub-objects, built from raw on first access
+	message: "Message" = LazyField("Message")
+
 	def __init__(self, data):
 		self.raw: dict = data
 
@@ -819,7 +951,6 @@ class CallbackQuery(ApiObject):
 		self.chat_instance: str = data.get("chat_instance")
 
 		# optional parameters
-		self.message: Message = self._get_optional(Message, "message")
 		self.inline_message_id: str = data.get("inline_message_id")
 		self.data: str = data.get("data")
 		self.game_short_name: str = data.get("game_short_name")
@@ -852,12 +983,20 @@ class File(ApiObject):
 		self.file_path: str = data.get("file_path")
 		self.file_size: int = data.get("file_size")
 
+		self._api_ref = None
+
 		# short parameters
 		# self.id: str = self.file_id
 		# self.unique_id: str = self.file_unique_id
 		# self.path: str = self.file_path
 		# self.size: int = self.file_size
 
+	def download(self, dest: any, chunk_size: int=64 * 1024) -> any:
+		"""streams the file to a path or a writable binary buffer, see TelegramAPI.download_file"""
+		if self._api_ref is None:
+			raise TelegramAPIError("File has no api reference, use TelegramAPI.download_file instead")
+		return self._api_ref.download_file(self, dest, chunk_size)
+
 class UserProfilePhotos(ApiObject):
 
 	def __init__(self, data):
@@ -876,7 +1015,17 @@ class TeleasyError(Exception):
 	pass
 
 class TelegramAPIError(TeleasyError):
-	pass
+
+	def __init__(self, message: str, error_code: int=None):
+		super().__init__(message)
+		self.error_code: int = error_code
+
+class TelegramFloodError(TelegramAPIError):
+	"""raised on 429 responses, retry_after is given in seconds"""
+
+	def __init__(self, message: str, retry_after: int):
+		super().__init__(message, 429)
+		self.retry_after: int = retry_after
 
 class MessageEditError(TeleasyError):
 	pass
@@ -887,6 +1036,44 @@ class MessageDeleteError(TeleasyError):
 class Message(ApiObject):
 	"""https://core.telegram.org/bots/api#message"""
 
+	# optional sub-objects, built from raw on first access
+	from_: "User" = LazyField("User", "from")
+	sender_chat: "Chat" = LazyField("Chat")
+	forward_from: "User" = LazyField("User")
+	forward_from_chat: "Chat" = LazyField("Chat")
+	reply_to_message: "Message" = LazyField("Message")
+	via_bot: "User" = LazyField("User")
+	entities: "list[MessageEntity]" = LazyField("MessageEntity", array=True)
+	animation: "Animation" = LazyField("Animation")
+	audio: "Audio" = LazyField("Audio")
+	document: "Document" = LazyField("Document")
+	photo: "list[PhotoSize]" = LazyField("PhotoSize", array=True)
+	sticker: "Sticker" = LazyField("Sticker")
+	video: "Video" = LazyField("Video")
+	video_note: "VideoNote" = LazyField("VideoNote")
+	voice: "Voice" = LazyField("Voice")
+	caption_entities: "list[MessageEntity]" = LazyField("MessageEntity", array=True)
+	contact: "Contact" = LazyField("Contact")
+	dice: "Dice" = LazyField("Dice")
+	game: "Game" = LazyField("Game")
+	poll: "Poll" = LazyField("Poll")
+	venue: "Venue" = LazyField("Venue")
+	location: "Location" = LazyField("Location")
+	new_chat_members: "list[User]" = LazyField("User", array=True)
+	left_chat_member: "User" = LazyField("User")
+	new_chat_photo: "list[PhotoSize]" = LazyField("PhotoSize", array=True)
+	message_auto_delete_timer_changed: "MessageAutoDeleteTimerChanged" = LazyField("MessageAutoDeleteTimerChanged")
+	pinned_message: "Message" = LazyField("Message")
+	invoice: "Invoice" = LazyField("Invoice")
+	successful_payment: "SuccessfulPayment" = LazyField("SuccessfulPayment")
+	passport_data: "PassportData" = LazyField("PassportData")
+	proximity_alert_triggered: "ProximityAlertTriggered" = LazyField("ProximityAlertTriggered")
+	voice_chat_scheduled: "VoiceChatScheduled" = LazyField("VoiceChatScheduled")
+	voice_chat_started: "VoiceChatStarted" = LazyField("VoiceChatStarted")
+	voice_chat_ended: "VoiceChatEnded" = LazyField("VoiceChatEnded")
+	voice_chat_participants_invited: "VoiceChatParticipantsInvited" = LazyField("VoiceChatParticipantsInvited")
+	reply_markup: "InlineKeyboardMarkup" = LazyField("InlineKeyboardMarkup")
+
 	def __init__(self, data):
 		self.raw: dict = data
 
@@ -897,64 +1084,23 @@ class Message(ApiObject):
 		self._bot_ref = None
 
 		# optional parameters
-		self.from_: User = self._get_optional(User, "from")
-		self.sender_chat: Chat = self._get_optional(Chat, "sender_chat")
-		self.forward_from: User = self._get_optional(User, "forward_from")
-		self.forward_from_chat: Chat = self._get_optional(Chat, "forward_from_chat")
 		self.forward_from_chat_id: int = data.get("forward_from_chat_id")
 		self.forward_signature: str = data.get("forward_signature")
 		self.forward_sender_name: str = data.get("forward_sender_name")
 		self.forward_date: int = data.get("forward_date")
-		self.reply_to_message: Message = self._get_optional(Message, "reply_to_message")
-		self.via_bot: User = self._get_optional(User, "via_bot")
 		self.edit_date: int = data.get("edit_date")
 		self.media_group_id: str = data.get("media_group_id")
 		self.author_signature: str = data.get("author_signature")
 		self.text: str = data.get("text")
-		self.entities: list[MessageEntity] = list()
-		self._get_array_of(MessageEntity, "entities")
-		self.animation: Animation = self._get_optional(Animation, "animation")
-		self.audio: Audio = self._get_optional(Audio, "audio")
-		self.document: Document = self._get_optional(Document, "document")
-		self.photo: list[PhotoSize] = list()
-		self._get_array_of(PhotoSize, "photo")
-		self.sticker: Sticker = self._get_optional(Sticker, "sticker")
-		self.video: Video = self._get_optional(Video, "video")
-		self.video_note: VideoNote = self._get_optional(VideoNote, "video_note")
-		self.voice: Voice = self._get_optional(Voice, "voice")
 		self.caption: str = data.get("caption")
-		self.caption_entities: list[MessageEntity] = list()
-		self._get_array_of(MessageEntity, "caption_entities")
-		self.contact: Contact = self._get_optional(Contact, "contact")
-		self.dice: Dice = self._get_optional(Dice, "dice")
-		self.game: Game = self._get_optional(Game, "game")
-		self.poll: Poll = self._get_optional(Poll, "poll")
-		self.venue: Venue = self._get_optional(Venue, "venue")
-		self.location: Location = self._get_optional(Location, "location")
-		self.new_chat_members: list[User] = list()
-		self._get_array_of(User, "new_chat_members")
-		self.left_chat_member: User = self._get_optional(User, "left_chat_member")
 		self.new_chat_title: str = data.get("new_chat_title")
-		self.new_chat_photo: list[PhotoSize] = list()
-		self._get_array_of(PhotoSize, "new_chat_photo")
 		self.delete_chat_photo: bool = self._get_optional(bool, "delete_chat_photo")
 		self.group_chat_created: bool = self._get_optional(bool, "group_chat_created")
 		self.supergroup_chat_created: bool = self._get_optional(bool, "supergroup_chat_created")
 		self.channel_chat_created: bool = self._get_optional(bool, "channel_chat_created")
-		self.message_auto_delete_timer_changed: MessageAutoDeleteTimerChanged = self._get_optional(MessageAutoDeleteTimerChanged, "message_auto_delete_timer_changed")
 		self.migrate_to_chat_id: int = data.get("migrate_to_chat_id")
 		self.migrate_from_chat_id: int = data.get("migrate_from_chat_id")
-		self.pinned_message: Message = self._get_optional(Message, "pinned_message")
-		self.invoice: Invoice = self._get_optional(Invoice, "invoice")
-		self.successful_payment: SuccessfulPayment = self._get_optional(SuccessfulPayment, "successful_payment")
 		self.connected_website: str = data.get("connected_website")
-		self.passport_data: PassportData = self._get_optional(PassportData, "passport_data")
-		self.proximity_alert_triggered: ProximityAlertTriggered = self._get_optional(ProximityAlertTriggered, "proximity_alert_triggered")
-		self.voice_chat_scheduled: VoiceChatScheduled = self._get_optional(VoiceChatScheduled, "voice_chat_scheduled")
-		self.voice_chat_started: VoiceChatStarted = self._get_optional(VoiceChatStarted, "voice_chat_started")
-		self.voice_chat_ended: VoiceChatEnded = self._get_optional(VoiceChatEnded, "voice_chat_ended")
-		self.voice_chat_participants_invited: VoiceChatParticipantsInvited = self._get_optional(VoiceChatParticipantsInvited, "voice_chat_participants_invited")
-		self.reply_markup: InlineKeyboardMarkup = self._get_optional(InlineKeyboardMarkup, "reply_markup")
 
 	def is_command(self):
 		return len(self.entities) > 0 and self.entities[0].type == MessageEntityType.BOT_COMMAND and self.entities[0].offset == 0
@@ -975,17 +1121,17 @@ class Message(ApiObject):
 	def edit(self, new_text, **kwargs):
 		if not self.is_editable:
 			raise MessageEditError("Tried editing non-editable Message")
-		self._bot_ref.api.edit_message_text(new_text, chat_id=self.chat.id, message_id=self.message_id, **kwargs)
+		return self._bot_ref.api.edit_message_text(new_text, chat_id=self.chat.id, message_id=self.message_id, **kwargs)
 
 	def edit_reply_keyboard(self, new_reply_keyboard: Optional[InlineKeyboardMarkup]=None, **kwargs):
 		if not self.is_editable:
 			raise MessageEditError("Tried editing non-editable Message")
-		self._bot_ref.api.edit_message_reply_markup(chat_id=self.chat.id, message_id=self.message_id, reply_markup=new_reply_keyboard)
+		return self._bot_ref.api.edit_message_reply_markup(chat_id=self.chat.id, message_id=self.message_id, reply_markup=new_reply_keyboard)
 
 	def delete(self):
 		if not self.is_editable:
 			raise MessageDeleteError("Tried deleting non-editable Message")
-		self._bot_ref.api.delete_message(chat_id=self.chat.id, message_id=self.message_id)
+		return self._bot_ref.api.delete_message(chat_id=self.chat.id, message_id=self.message_id)
 
 	def __eq__(self, other: object) -> bool:
 		if isinstance(other, str):
@@ -997,54 +1143,900 @@ class Message(ApiObject):
 class Update(ApiObject):
 	"""https://core.telegram.org/bots/api#update"""
 
+	# optional sub-objects, built from raw on first access
+	message: "Message" = LazyField("Message")
+	edited_message: "Message" = LazyField("Message")
+	channel_post: "Message" = LazyField("Message")
+	edited_channel_post: "Message" = LazyField("Message")
+	callback_query: "CallbackQuery" = LazyField("CallbackQuery")
+	poll: "Poll" = LazyField("Poll")
+	poll_answer: "PollAnswer" = LazyField("PollAnswer")
+	my_chat_member: "ChatMemberUpdated" = LazyField("ChatMemberUpdated")
+	chat_member: "ChatMemberUpdated" = LazyField("ChatMemberUpdated")
+	chat_join_request: "ChatJoinRequest" = LazyField("ChatJoinRequest")
+
 	def __init__(self, data):
 		self.raw: dict = data
 
 		self.update_id: int = data["update_id"]
-		
-		# optional parameters
-		self.message: Message = self._get_optional(Message, "message")
-		self.edited_message: Message = self._get_optional(Message, "edited_message")
-		self.channel_post: Message = self._get_optional(Message, "channel_post")
-		self.edited_channel_post: Message = self._get_optional(Message, "edited_channel_post")
-		self.callback_query: CallbackQuery = self._get_optional(CallbackQuery, "callback_query")
-		self.poll: Poll = self._get_optional(Poll, "poll")
-		self.poll_answer: PollAnswer = self._get_optional(PollAnswer, "poll_answer")
-		self.my_chat_member: ChatMemberUpdated = self._get_optional(ChatMemberUpdated, "my_chat_member")
-		self.chat_member: ChatMemberUpdated = self._get_optional(ChatMemberUpdated, "chat_member")
-		self.chat_join_request: ChatJoinRequest = self._get_optional(ChatJoinRequest, "chat_join_request")
+
+class RateBucket:
+	"""token bucket in its GCRA form: only stores the time at which the next send is due"""
+
+	def __init__(self, rate: float, burst: int=1):
+		self.interval: float = 1 / rate
+		self.tolerance: float = (burst - 1) * self.interval
+		self.due: float = 0.0
+		self.paused_until: float = 0.0
+
+	def earliest(self, now: float) -> float:
+		return max(now, self.due - self.tolerance, self.paused_until)
+
+	def commit(self, at: float) -> None:
+		self.due = max(self.due, at) + self.interval
+
+	def is_idle(self, now: float) -> bool:
+		return self.due <= now and self.paused_until <= now
+
+class RateLimiter:
+	"""keeps outgoing messages within Telegram's flood limits
+	(https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this)
+
+	Every rate limited call reserves a slot in the global bucket and in the
+	bucket of its chat, private chats and groups/channels having separate rates.
+	reserve() returns how long the caller has to wait, so it works for both the
+	threaded and the asyncio client."""
+
+	LIMITED_PREFIXES = ("send", "forward", "copy", "edit")
+
+	def __init__(self, global_rate: float=30, chat_rate: float=1, group_rate: float=20 / 60, chat_burst: int=3):
+		self.global_rate: float = global_rate
+		self.chat_rate: float = chat_rate
+		self.group_rate: float = group_rate
+		self.chat_burst: int = chat_burst
+		# at least 1, a sharded bot splits global_rate between its processes
+		self.global_bucket = RateBucket(global_rate, burst=max(int(global_rate), 1))
+		self.chat_buckets = dict()
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def is_group(chat_id: int or str) -> bool:
+		# groups, supergroups and channels have negative ids, channels may also be given as "@name"
+		return isinstance(chat_id, str) or chat_id < 0
+
+	def is_limited(self, func_name: str) -> bool:
+		return func_name.startswith(self.LIMITED_PREFIXES)
+
+	def _chat_bucket(self, chat_id: int or str) -> RateBucket:
+		if chat_id not in self.chat_buckets:
+			if len(self.chat_buckets) > 10000:
+				self._prune(time.monotonic())
+			rate = self.group_rate if self.is_group(chat_id) else self.chat_rate
+			self.chat_buckets[chat_id] = RateBucket(rate, burst=self.chat_burst)
+		return self.chat_buckets[chat_id]
+
+	def _prune(self, now: float) -> None:
+		self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.is_idle(now)}
+
+	def reserve(self, func_name: str, chat_id: int or str=None) -> float:
+		"""books the next free slot and returns the seconds to wait before sending"""
+		if not self.is_limited(func_name):
+			return 0.0
+		with self._lock:
+			now = time.monotonic()
+			buckets = [self.global_bucket]
+			if chat_id is not None:
+				buckets.append(self._chat_bucket(chat_id))
+			at = max(b.earliest(now) for b in buckets)
+			for bucket in buckets:
+				bucket.commit(at)
+			return at - now
+
+	def pause(self, seconds: float, chat_id: int or str=None) -> None:
+		"""called on a 429 response: holds back the chat (or everything if chat_id is None)"""
+		with self._lock:
+			bucket = self.global_bucket if chat_id is None else self._chat_bucket(chat_id)
+			bucket.paused_until = max(bucket.paused_until, time.monotonic() + seconds)
+
+class Metrics:
+	"""counters, gauges and latency histograms, readable as snapshot() or in Prometheus text format
+
+	Every metric is declared once with its label names, values are then updated
+	with the label values in the same order."""
+
+	BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		# name -> (type, help, label names)
+		self._declared: dict = dict()
+		# name -> {label values: number, or [bucket counts, sum, count] for histograms}
+		self._values: dict = dict()
+		# name -> function returning the current value of a gauge
+		self._gauge_funcs: dict = dict()
+
+	def _declare(self, kind: str, name: str, help: str, labels: tuple) -> None:
+		with self._lock:
+			if name not in self._declared:
+				self._declared[name] = (kind, help, tuple(labels))
+				self._values[name] = dict()
+				if not labels and kind != "histogram":
+					self._values[name][()] = 0
+
+	def counter(self, name: str, help: str, labels: tuple=()) -> None:
+		self._declare("counter", name, help, labels)
+
+	def histogram(self, name: str, help: str, labels: tuple=()) -> None:
+		self._declare("histogram", name, help, labels)
+
+	def gauge(self, name: str, help: str, labels: tuple=(), func=None) -> None:
+		"""with func, the gauge is read by calling func() on export instead of being updated"""
+		self._declare("gauge", name, help, labels)
+		if func is not None:
+			self._gauge_funcs[name] = func
+
+	def inc(self, name: str, *labels: str, value: float=1) -> None:
+		"""adds value to a counter or gauge, gauges may also be decreased"""
+		with self._lock:
+			values = self._values[name]
+			values[labels] = values.get(labels, 0) + value
+
+	def observe(self, name: str, seconds: float, *labels: str) -> None:
+		with self._lock:
+			values = self._values[name]
+			entry = values.get(labels)
+			if entry is None:
+				entry = values[labels] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+			entry[0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+			entry[1] += seconds
+			entry[2] += 1
+
+	def snapshot(self) -> dict:
+		"""name -> {label values: value}, histograms as {"count", "sum", "buckets": {upper bound: cumulative count}}"""
+		snapshot = dict()
+		with self._lock:
+			for name, (kind, _, _) in self._declared.items():
+				if kind == "histogram":
+					snapshot[name] = {labels: self._histogram_dict(entry) for labels, entry in self._values[name].items()}
+				else:
+					snapshot[name] = dict(self._values[name])
+		for name, func in self._gauge_funcs.items():
+			snapshot[name] = {(): func()}
+		return snapshot
+
+	def _histogram_dict(self, entry: list) -> dict:
+		bucket_counts, total, count = entry
+		buckets = dict()
+		cumulative = 0
+		for bound, bucket_count in zip(self.BUCKETS + (float("inf"),), bucket_counts):
+			cumulative += bucket_count
+			buckets[bound] = cumulative
+		return {"count": count, "sum": total, "buckets": buckets}
+
+	@staticmethod
+	def _labels_text(names: tuple, values: tuple, extra: str=None) -> str:
+		pairs = [f'{name}="{Metrics._escape(value)}"' for name, value in zip(names, values)]
+		if extra:
+			pairs.append(extra)
+		return "{" + ",".join(pairs) + "}" if pairs else ""
+
+	@staticmethod
+	def _escape(value: any) -> str:
+		return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+	def to_prometheus(self) -> str:
+		lines = list()
+		snapshot = self.snapshot()
+		for name, (kind, help, label_names) in self._declared.items():
+			lines.append(f"# HELP {name} {help}")
+			lines.append(f"# TYPE {name} {kind}")
+			for labels, value in snapshot[name].items():
+				if kind != "histogram":
+					lines.append(f"{name}{self._labels_text(label_names, labels)} {value}")
+					continue
+				for bound, cumulative in value["buckets"].items():
+					le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+					lines.append(f"{name}_bucket{self._labels_text(label_names, labels, le)} {cumulative}")
+				lines.append(f"{name}_sum{self._labels_text(label_names, labels)} {value['sum']}")
+				lines.append(f"{name}_count{self._labels_text(label_names, labels)} {value['count']}")
+		return "\n".join(lines) + "\n"
+
+class HandlerProfile:
+	"""where the time of one handler run went: wall time, time blocked in TelegramAPI.call
+	and time waiting for user input. cpu is the thread CPU time (None for coroutines)"""
+
+	__slots__ = ("name", "wall", "cpu", "api_time", "api_calls", "wait_time", "waits", "methods", "stats")
+
+	def __init__(self, name: str):
+		self.name: str = name
+		self.wall: float = 0.0
+		self.cpu: Optional[float] = None
+		self.api_time: float = 0.0
+		self.api_calls: int = 0
+		self.wait_time: float = 0.0
+		self.waits: int = 0
+		# method -> [calls, seconds]
+		self.methods: dict = dict()
+		# pstats.Stats of the run if function profiling is on
+		self.stats = None
+
+	@property
+	def other_time(self) -> float:
+		"""wall time not spent in api calls or waiting, the handler's own work"""
+		return max(self.wall - self.api_time - self.wait_time, 0.0)
+
+	def add_api_call(self, func_name: str, seconds: float) -> None:
+		self.api_time += seconds
+		self.api_calls += 1
+		entry = self.methods.setdefault(func_name, [0, 0.0])
+		entry[0] += 1
+		entry[1] += seconds
+
+	def add_wait(self, seconds: float) -> None:
+		self.wait_time += seconds
+		self.waits += 1
+
+	def __str__(self) -> str:
+		cpu = "" if self.cpu is None else f", cpu {self.cpu * 1000:.1f}ms"
+		methods = ", ".join(f"{name} {calls}x {seconds * 1000:.1f}ms" for name, (calls, seconds) in self.methods.items())
+		return (f"{self.name}: wall {self.wall * 1000:.1f}ms{cpu}, api {self.api_time * 1000:.1f}ms in {self.api_calls} calls"
+			+ (f" ({methods})" if methods else "")
+			+ f", waiting {self.wait_time * 1000:.1f}ms in {self.waits} waits, other {self.other_time * 1000:.1f}ms")
+
+# the HandlerProfile of the handler running in this thread or task, None if it isn't profiled
+current_profile: contextvars.ContextVar = contextvars.ContextVar("teleasy_current_profile", default=None)
+
+class JSONCodec:
+	"""JSON encoding/decoding used by TelegramAPI, picks the fastest installed backend
+
+	backend may be "orjson", "ujson" or "json" (stdlib), None selects automatically.
+	dumps always returns compact utf-8 bytes."""
+
+	BACKENDS = ("orjson", "ujson", "json")
+
+	def __init__(self, backend: str=None):
+		if backend is None:
+			backend = next(b for b in self.BACKENDS if self.is_available(b))
+		if not self.is_available(backend):
+			raise TeleasyError(f"JSON backend '{backend}' is not installed")
+		self.backend: str = backend
+		if backend == "orjson":
+			self.dumps = orjson.dumps
+			self.loads = orjson.loads
+		elif backend == "ujson":
+			self.dumps = lambda obj: ujson.dumps(obj, ensure_ascii=False).encode("utf-8")
+			self.loads = ujson.loads
+		else:
+			self.dumps = lambda obj: json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+			self.loads = json.loads
+
+	@staticmethod
+	def is_available(backend: str) -> bool:
+		return {"orjson": orjson, "ujson": ujson, "json": json}.get(backend) is not None
+
+class InputFile:
+	"""a local file to upload: a path, a binary file object or a bytes-like buffer (e.g. an mmap)
+
+	The content is streamed in chunks when the request is sent, it is never
+	read into memory as a whole."""
+
+	CHUNK_SIZE = 64 * 1024
+
+	def __init__(self, source: any, filename: str=None, mime_type: str="application/octet-stream"):
+		self.source = source
+		self.mime_type: str = mime_type
+		if filename is None:
+			if isinstance(source, (str, os.PathLike)):
+				filename = os.path.basename(source)
+			else:
+				# files opened from a descriptor (e.g. a pipe) have its number as name
+				name = getattr(source, "name", None)
+				filename = (os.path.basename(name) if isinstance(name, str) else "") or "file"
+		self.filename: str = filename
+		# mmaps have read() too, but they are sent as a whole like any other buffer
+		self._buffer: bool = self._is_buffer(source)
+		# pipes and sockets can only be read once, as the request is sent
+		self.seekable: bool = not hasattr(source, "read") or self._buffer or bool(getattr(source, "seekable", lambda: False)())
+		# file objects are rewound to this position when a request is retried
+		self._start = source.tell() if hasattr(source, "read") and not self._buffer and self.seekable else 0
+
+	@staticmethod
+	def is_file(value: any) -> bool:
+		"""plain strings are file_ids or URLs, local paths have to be given as InputFile or pathlib.Path"""
+		return isinstance(value, (InputFile, os.PathLike, bytes, bytearray, memoryview, mmap.mmap)) or hasattr(value, "read")
+
+	@staticmethod
+	def _is_buffer(value: any) -> bool:
+		try:
+			memoryview(value)
+		except TypeError:
+			return False
+		return True
+
+	@staticmethod
+	def wrap(value: any) -> "InputFile":
+		return value if isinstance(value, InputFile) else InputFile(value)
+
+	def size(self) -> int:
+		if isinstance(self.source, (str, os.PathLike)):
+			return os.path.getsize(self.source)
+		if self._buffer:
+			return memoryview(self.source).nbytes
+		try:
+			file_stat = os.fstat(self.source.fileno())
+		except (AttributeError, OSError):
+			file_stat = None
+		# st_size is 0 for pipes and sockets
+		if file_stat is not None and stat.S_ISREG(file_stat.st_mode):
+			return file_stat.st_size - self._start
+		if not self.seekable:
+			raise TeleasyError(f"the size of '{self.filename}' is unknown, it is not seekable (pass its content as bytes)")
+		position = self.source.tell()
+		self.source.seek(0, os.SEEK_END)
+		end = self.source.tell()
+		self.source.seek(position)
+		return end - self._start
+
+	def chunks(self, chunk_size: int=CHUNK_SIZE):
+		if isinstance(self.source, (str, os.PathLike)):
+			with open(self.source, "rb") as f:
+				yield from iter(lambda: f.read(chunk_size), b"")
+		elif self._buffer:
+			view = memoryview(self.source).cast("B")
+			for offset in range(0, len(view), chunk_size):
+				yield bytes(view[offset:offset + chunk_size])
+		else:
+			if self.seekable:
+				self.source.seek(self._start)
+			yield from iter(lambda: self.source.read(chunk_size), b"")
+
+class MultipartEncoder:
+	"""multipart/form-data body with a known length that is generated while it is sent"""
+
+	def __init__(self, fields: dict, files: dict):
+		self.boundary: str = uuid.uuid4().hex
+		self.parts: list = list()
+		for name, value in fields.items():
+			self.parts.append(self._header(name) + (value if isinstance(value, bytes) else str(value).encode("utf-8")) + b"\r\n")
+		for name, input_file in files.items():
+			self.parts.append(self._header(name, input_file))
+			self.parts.append(input_file)
+			self.parts.append(b"\r\n")
+		self.parts.append(f"--{self.boundary}--\r\n".encode("utf-8"))
+		self._iterator = None
+		self._buffer = b""
+
+	def _header(self, name: str, input_file: InputFile=None) -> bytes:
+		header = f"--{self.boundary}\r\nContent-Disposition: form-data; name=\"{name}\""
+		if input_file:
+			filename = input_file.filename.replace('"', "")
+			header += f"; filename=\"{filename}\"\r\nContent-Type: {input_file.mime_type}"
+		return (header + "\r\n\r\n").encode("utf-8")
+
+	@property
+	def content_type(self) -> str:
+		return f"multipart/form-data; boundary={self.boundary}"
+
+	def __len__(self) -> int:
+		return sum(part.size() if isinstance(part, InputFile) else len(part) for part in self.parts)
+
+	def __iter__(self):
+		for part in self.parts:
+			if isinstance(part, InputFile):
+				yield from part.chunks()
+			else:
+				yield part
+
+	def read(self, size: int=-1) -> bytes:
+		"""file-like access, used by http.client to stream the body"""
+		if self._iterator is None:
+			self._iterator = iter(self)
+		while size < 0 or len(self._buffer) < size:
+			chunk = next(self._iterator, None)
+			if chunk is None:
+				break
+			self._buffer += chunk
+		if size < 0:
+			size = len(self._buffer)
+		out, self._buffer = self._buffer[:size], self._buffer[size:]
+		return out
+
+class FileCache:
+	"""downloaded files on disk, keyed by file_unique_id (which is the same for every bot)"""
+
+	def __init__(self, directory: str):
+		self.directory: str = directory
+		os.makedirs(directory, exist_ok=True)
+
+	def path(self, file_unique_id: str) -> str:
+		return os.path.join(self.directory, file_unique_id)
+
+	def get(self, file_unique_id: str) -> Optional[str]:
+		path = self.path(file_unique_id)
+		return path if os.path.isfile(path) else None
+
+	def temp_path(self, file_unique_id: str) -> str:
+		return f"{self.path(file_unique_id)}.{uuid.uuid4().hex}.part"
+
+	def commit(self, temp_path: str, file_unique_id: str) -> None:
+		# atomic, a concurrent reader never sees a partial file
+		os.replace(temp_path, self.path(file_unique_id))
+
+	def clear(self) -> None:
+		for name in os.listdir(self.directory):
+			os.remove(os.path.join(self.directory, name))
+
+class UploadCache:
+	"""file_ids of uploaded files, keyed by path + mtime + size for paths and by the
+	sha256 of the content for buffers and seekable file objects. Pipes and sockets
+	can only be read once, by the upload, so they are not cached
+
+	file_ids are only valid for the bot that uploaded the file, so every bot needs
+	its own cache file. The file is append-only JSON lines."""
+
+	def __init__(self, path: str):
+		self.path: str = path
+		self.file_ids: dict = dict()
+		self._pending: dict = dict()
+		self._lock = threading.Lock()
+		if os.path.isfile(path):
+			with open(path, "r", encoding="utf-8") as f:
+				for line in f:
+					if line.strip():
+						entry = json.loads(line)
+						self.file_ids[entry["key"]] = entry["file_id"]
+
+	@staticmethod
+	def key(input_file: InputFile) -> Optional[str]:
+		"""None if the file can't be cached"""
+		source = input_file.source
+		if isinstance(source, (str, os.PathLike)):
+			file_stat = os.stat(source)
+			return f"path:{os.path.abspath(source)}:{file_stat.st_mtime_ns}:{file_stat.st_size}"
+		if not input_file.seekable:
+			return None
+		digest = hashlib.sha256()
+		for chunk in input_file.chunks():
+			digest.update(chunk)
+		return f"sha256:{digest.hexdigest()}"
+
+	def acquire(self, key: str, wait: bool=True) -> Optional[str]:
+		"""returns the cached file_id or None, in which case the caller uploads the file and
+		has to call put or release. With wait, concurrent callers of the same key wait for
+		the first upload instead of uploading the file again"""
+		while True:
+			with self._lock:
+				if key in self.file_ids:
+					return self.file_ids[key]
+				event = self._pending.get(key)
+				if event is None or not wait:
+					self._pending.setdefault(key, threading.Event())
+					return None
+			event.wait()
+
+	def put(self, key: str, file_id: str) -> None:
+		with self._lock:
+			if self.file_ids.get(key) != file_id:
+				self.file_ids[key] = file_id
+				with open(self.path, "a", encoding="utf-8") as f:
+					f.write(json.dumps({"key": key, "file_id": file_id}) + "\n")
+		self.release(key)
+
+	def release(self, key: str) -> None:
+		with self._lock:
+			event = self._pending.pop(key, None)
+		if event is not None:
+			event.set()
+
+class DownloadSink:
+	"""writes downloaded chunks to the destination and, if given, to the cache at the same time"""
+
+	def __init__(self, dest: any, cache: Optional[FileCache]=None, file_unique_id: str=None):
+		self.is_path: bool = isinstance(dest, (str, os.PathLike))
+		self.out = open(dest, "wb") if self.is_path else dest
+		self.cache: Optional[FileCache] = cache
+		self.file_unique_id: str = file_unique_id
+		self.cache_path: Optional[str] = None
+		self.cache_out = None
+		if cache is not None and file_unique_id:
+			self.cache_path = cache.temp_path(file_unique_id)
+			self.cache_out = open(self.cache_path, "wb")
+
+	def write(self, chunk: bytes) -> None:
+		self.out.write(chunk)
+		if self.cache_out is not None:
+			self.cache_out.write(chunk)
+
+	def __enter__(self) -> "DownloadSink":
+		return self
+
+	def __exit__(self, exc_type, exc, traceback) -> None:
+		if self.is_path:
+			self.out.close()
+		if self.cache_out is not None:
+			self.cache_out.close()
+			if exc_type is None:
+				self.cache.commit(self.cache_path, self.file_unique_id)
+			else:
+				os.remove(self.cache_path)
+
+	@staticmethod
+	def copy(source_path: str, dest: any, chunk_size: int=64 * 1024) -> None:
+		"""serves a cached file"""
+		if isinstance(dest, (str, os.PathLike)):
+			shutil.copyfile(source_path, dest)
+			return
+		with open(source_path, "rb") as source:
+			while chunk := source.read(chunk_size):
+				dest.write(chunk)
+
+class HTTPTransport:
+	"""keep-alive connection pool shared by every call of a TelegramAPI"""
+
+	# encoded arguments larger than this are sent as POST body instead of query string
+	POST_THRESHOLD = 2048
+
+	def __init__(self, pool_size: int=10, connect_timeout: float=5.0, read_timeout: float=30.0):
+		self.pool_size: int = pool_size
+		self.connect_timeout: float = connect_timeout
+		self.read_timeout: float = read_timeout
+		self.session: requests.Session = self._make_session()
+
+	def _make_session(self) -> requests.Session:
+		session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+		session.mount("https://", adapter)
+		session.mount("http://", adapter)
+		return session
+
+	def request(self, method: str, url: str, extra_read_timeout: float=0.0, **kwargs) -> requests.Response:
+		timeout = (self.connect_timeout, self.read_timeout + extra_read_timeout)
+		return self.session.request(method, url, timeout=timeout, **kwargs)
+
+	def get(self, url: str, **kwargs) -> requests.Response:
+		return self.request("GET", url, **kwargs)
+
+	def send(self, url: str, args: dict, files: dict=None, extra_read_timeout: float=0.0) -> bytes:
+		"""GET for small calls, url-encoded POST for large ones and streamed multipart POST for uploads"""
+		if files:
+			body = MultipartEncoder(args, files)
+			response = self.request("POST", url, data=body, headers={"Content-Type": body.content_type},
+				extra_read_timeout=extra_read_timeout)
+		elif sum(len(v) for v in args.values()) > self.POST_THRESHOLD:
+			response = self.request("POST", url, data=args, extra_read_timeout=extra_read_timeout)
+		else:
+			response = self.request("GET", url, params=args, extra_read_timeout=extra_read_timeout)
+		return response.content
+
+	def download(self, url: str, write: callable, chunk_size: int=64 * 1024) -> None:
+		with self.request("GET", url, stream=True) as response:
+			if response.status_code != 200:
+				raise TelegramAPIError(f"Download failed with HTTP status {response.status_code}", response.status_code)
+			for chunk in response.iter_content(chunk_size):
+				write(chunk)
+
+	def close(self) -> None:
+		"""closes all pooled connections, the transport may still be used afterwards"""
+		self.session.close()
+		self.session = self._make_session()
+
+class UpdateJournal:
+	"""raw updates as JSON lines, {"time": <unix time>, "update": <raw update>} per line.
+	Paths ending in .gz are gzip compressed"""
+
+	def __init__(self, path: str, codec: JSONCodec=None):
+		self.path: str = path
+		self.codec: JSONCodec = codec if codec is not None else JSONCodec()
+		self._file = None
+		self._lock = threading.Lock()
+
+	def _open(self, mode: str):
+		return gzip.open(self.path, mode) if self.path.endswith(".gz") else open(self.path, mode)
+
+	def record(self, updates: List[dict]) -> None:
+		if not updates:
+			return
+		now = time.time()
+		lines = b"".join(self.codec.dumps({"time": now, "update": update}) + b"\n" for update in updates)
+		with self._lock:
+			if self._file is None:
+				self._file = self._open("ab")
+			self._file.write(lines)
+			# one flush per batch, a crash loses at most the batch being written
+			self._file.flush()
+
+	def __iter__(self):
+		"""yields (time, raw update) in recorded order"""
+		with self._open("rb") as f:
+			for line in f:
+				if line.strip():
+					entry = self.codec.loads(line)
+					yield entry["time"], entry["update"]
+
+	def close(self) -> None:
+		with self._lock:
+			if self._file is not None:
+				self._file.close()
+				self._file = None
+
+class NullTransport:
+	"""HTTPTransport stand-in that sends nothing: every call succeeds with a plausible result,
+	sending methods return a Message. Used to replay recorded traffic offline"""
+
+	MESSAGE_PREFIXES = ("send", "forward", "copy", "edit")
+
+	def __init__(self):
+		self.calls = collections.Counter()
+		self._message_ids = itertools.count(1)
+
+	@staticmethod
+	def _decode(value: any) -> any:
+		# _encode_args leaves strings as they are and JSON encodes everything else
+		return json.loads(value) if isinstance(value, bytes) else value
+
+	def result(self, func_name: str, args: dict) -> any:
+		if func_name == "getUpdates":
+			return list()
+		if func_name == "getMe":
+			return {"id": 0, "is_bot": True, "first_name": "NullTransport"}
+		if func_name.startswith(self.MESSAGE_PREFIXES) and "chat_id" in args:
+			chat_id = self._decode(args["chat_id"])
+			chat_type = "private" if isinstance(chat_id, int) and chat_id > 0 else "supergroup"
+			message = {"message_id": next(self._message_ids), "date": int(time.time()), "chat": {"id": chat_id, "type": chat_type}}
+			if "text" in args:
+				message["text"] = self._decode(args["text"])
+			return message
+		return True
+
+	def send(self, url: str, args: dict, files: dict=None, extra_read_timeout: float=0.0) -> bytes:
+		func_name = url.rsplit("/", 1)[-1]
+		self.calls[func_name] += 1
+		return json.dumps({"ok": True, "result": self.result(func_name, args)}).encode("utf-8")
+
+	def download(self, url: str, write: callable, chunk_size: int=64 * 1024) -> None:
+		pass
+
+	def close(self) -> None:
+		pass
 
 class TelegramAPI:
 
-	def __init__(self, token: str):
+	DEFAULT_BASE_URL = "https://api.telegram.org"
+	transport_type = HTTPTransport
+
+	def __init__(self, token: str, pool_size: int=10, connect_timeout: float=5.0, read_timeout: float=30.0,
+			base_url: str=DEFAULT_BASE_URL):
 		self.token: str = token
+		# e.g. a local Bot API server or a stand-in for benchmarks
+		self.base_url: str = base_url.rstrip("/")
 		self.offset: int = 0
+		self.transport: HTTPTransport = self.transport_type(pool_size, connect_timeout, read_timeout)
+		self.codec: JSONCodec = JSONCodec()
+		# set to None to disable client-side flood control
+		self.rate_limiter: RateLimiter = RateLimiter()
+		self.file_cache: Optional[FileCache] = None
+		self.set_max_downloads(4)
+		self.upload_cache: Optional[UploadCache] = None
+		# set to None to disable metrics
+		self.metrics: Metrics = self._make_metrics()
+		self.journal: Optional[UpdateJournal] = None
 
 	def set_bot(self, bot):
 		self._bot_ref = bot
 
-	def call(self, func_name: str, args=dict()) -> dict:
-		url = f"https://api.telegram.org/bot{self.token}/{func_name}"
+	@staticmethod
+	def _make_metrics() -> Metrics:
+		metrics = Metrics()
+		metrics.counter("teleasy_api_requests_total", "Bot API calls by method and result", ("method", "status"))
+		metrics.histogram("teleasy_api_request_seconds", "Bot API call latency including retries", ("method",))
+		metrics.counter("teleasy_api_flood_waits_total", "429 responses by method", ("method",))
+		return metrics
+
+	def _record_call(self, func_name: str, started: float, status: str) -> None:
+		profile = current_profile.get()
+		if self.metrics is None and profile is None:
+			return
+		seconds = time.perf_counter() - started
+		if self.metrics is not None:
+			self.metrics.inc("teleasy_api_requests_total", func_name, status)
+			self.metrics.observe("teleasy_api_request_seconds", seconds, func_name)
+		if profile is not None:
+			profile.add_api_call(func_name, seconds)
+
+	def set_upload_cache(self, path: str) -> None:
+		"""uploaded files are remembered in path, sending the same file again reuses its file_id"""
+		self.upload_cache = UploadCache(path)
+
+	def record_updates(self, path: str) -> UpdateJournal:
+		"""appends every update returned by getUpdates to an UpdateJournal at path (.gz to compress)"""
+		self.journal = UpdateJournal(path, self.codec)
+		return self.journal
+
+	def set_file_cache(self, directory: str) -> None:
+		"""downloads are stored in directory and served from there on repeated requests"""
+		self.file_cache = FileCache(directory)
+
+	def set_max_downloads(self, max_downloads: int) -> None:
+		self.download_limit = threading.BoundedSemaphore(max_downloads)
+
+	def _url(self, func_name: str) -> str:
+		return f"{self.base_url}/bot{self.token}/{func_name}"
+
+	def _file_url(self, file_path: str) -> str:
+		return f"{self.base_url}/file/bot{self.token}/{file_path}"
+
+	def _cached_file(self, file: str or ApiObject) -> Optional[str]:
+		file_unique_id = getattr(file, "file_unique_id", None)
+		if self.file_cache is None or not file_unique_id:
+			return None
+		return self.file_cache.get(file_unique_id)
+
+	@staticmethod
+	def _needs_file_info(file: str or ApiObject) -> bool:
+		return not (isinstance(file, File) and file.file_path)
+
+	def download_file(self, file: str or ApiObject, dest: any, chunk_size: int=64 * 1024) -> any:
+		"""streams a file to a path or a writable binary buffer and returns dest
+
+		file is a file_id or any object with file_id and file_unique_id (File, PhotoSize,
+		Document, Sticker, ...). Those are served from the file cache without calling
+		getFile. At most max_downloads files are downloaded at the same time."""
+		cached = self._cached_file(file)
+		if cached is None and self._needs_file_info(file):
+			file = self.get_file(file if isinstance(file, str) else file.file_id)
+			cached = self._cached_file(file)
+		if cached is not None:
+			DownloadSink.copy(cached, dest, chunk_size)
+			return dest
+		with self.download_limit:
+			with DownloadSink(dest, self.file_cache, file.file_unique_id) as sink:
+				self.transport.download(self._file_url(file.file_path), sink.write, chunk_size)
+		return dest
+
+	def _reuse_uploads(self, args: dict, wait: bool=True) -> tuple:
+		"""replaces local files by their cached file_id. Returns the new args and a list of
+		(key, result index, result field) for the files that still have to be uploaded"""
+		if self.upload_cache is None:
+			return args, []
+		args = dict(args)
+		uploads = list()
+		# key -> file_id, or None if this call uploads the file. The same file twice in a media
+		# group must not wait for the upload it started itself
+		acquired = dict()
+
+		def reuse(value: any, index: Optional[int], field: str) -> any:
+			input_file = InputFile.wrap(value)
+			key = self.upload_cache.key(input_file)
+			if key is None:
+				return input_file
+			if key in acquired:
+				return acquired[key] if acquired[key] is not None else input_file
+			file_id = self.upload_cache.acquire(key, wait)
+			acquired[key] = file_id
+			if file_id is not None:
+				return file_id
+			uploads.append((key, index, field))
+			return input_file
+
+		for key, value in args.items():
+			# thumbnails can't be reused by file_id
+			if InputFile.is_file(value) and key != "thumb":
+				args[key] = reuse(value, None, key)
+			elif isinstance(value, InputMedia) or (isinstance(value, list) and any(isinstance(v, InputMedia) or (isinstance(v, dict) and "media" in v) for v in value)):
+				media_list = list()
+				for i, media in enumerate(value if isinstance(value, list) else [value]):
+					media = media.to_dict() if isinstance(media, ApiObject) else dict(media)
+					if InputFile.is_file(media.get("media")):
+						media["media"] = reuse(media["media"], i if isinstance(value, list) else None, media.get("type"))
+					media_list.append(media)
+				args[key] = media_list if isinstance(value, list) else media_list[0]
+		return args, uploads
+
+	def _record_uploads(self, uploads: list, result: any) -> None:
+		for key, index, field in uploads:
+			message = result[index] if index is not None and isinstance(result, list) and index < len(result) else result
+			value = message.get(field) if isinstance(message, dict) else None
+			if isinstance(value, list) and value:
+				# photos come in several sizes, the largest one is last
+				value = value[-1]
+			if isinstance(value, dict) and "file_id" in value:
+				self.upload_cache.put(key, value["file_id"])
+			else:
+				self.upload_cache.release(key)
+
+	def _release_uploads(self, uploads: list) -> None:
+		for key, _, _ in uploads:
+			self.upload_cache.release(key)
+
+	def _extract_files(self, args: dict) -> tuple:
+		"""moves local files out of args into a separate dict of InputFiles. Files inside
+		InputMedia lists (send_media_group, edit_message_media) are referenced as attach://<name>"""
+		args = dict(args)
+		files = dict()
+		for key, value in list(args.items()):
+			if InputFile.is_file(value):
+				files[key] = InputFile.wrap(args.pop(key))
+			elif isinstance(value, InputMedia) or (isinstance(value, list) and any(isinstance(v, InputMedia) or (isinstance(v, dict) and "media" in v) for v in value)):
+				media_list = list()
+				for media in (value if isinstance(value, list) else [value]):
+					media = media.to_dict() if isinstance(media, ApiObject) else dict(media)
+					for field in ("media", "thumb"):
+						if InputFile.is_file(media.get(field)):
+							name = f"file{len(files)}"
+							files[name] = InputFile.wrap(media[field])
+							media[field] = f"attach://{name}"
+					media_list.append(media)
+				args[key] = media_list if isinstance(value, list) else media_list[0]
+		return args, files
+
+	def _encode_args(self, args: dict) -> dict:
 		args = {k: v for k, v in args.items() if v is not None}
 		for k, v in args.items():
 			if isinstance(v, ApiObject):
-				args[k] = json.dumps(v._export())
-			if not isinstance(args[k], str):
-				args[k] = json.dumps(args[k])
+				args[k] = v._encode(self.codec)
+			elif not isinstance(v, str):
+				args[k] = self.codec.dumps(v)
+		return args
+
+	def _decode_result(self, func_name: str, content: bytes) -> any:
+		result = self.codec.loads(content)
+		if result["ok"]:
+			return result["result"]
+		elif "retry_after" in result.get("parameters", dict()):
+			if self.metrics is not None:
+				self.metrics.inc("teleasy_api_flood_waits_total", func_name)
+			raise TelegramFloodError((
+				f"\"{func_name}\": "
+				f"{result['description']} "
+				f"[Error Code {result['error_code']}]"
+			), result["parameters"]["retry_after"])
+		else:
+			raise TelegramAPIError((
+				f"\"{func_name}\": "
+				f"{result['description']} "
+				f"[Error Code {result['error_code']}]"
+			), result["error_code"])
+
+	def _reserve(self, func_name: str, chat_id: int or str) -> float:
+		if self.rate_limiter is None:
+			return 0.0
+		return self.rate_limiter.reserve(func_name, chat_id)
+
+	def _pause(self, error: "TelegramFloodError", chat_id: int or str) -> None:
+		if self.rate_limiter is None:
+			time.sleep(error.retry_after)
+		else:
+			self.rate_limiter.pause(error.retry_after, chat_id)
+
+	def call(self, func_name: str, args=dict(), extra_read_timeout: float=0.0) -> dict:
+		started = time.perf_counter()
+		status = "error"
+		args, uploads = self._reuse_uploads(args)
+		try:
+			result = self._send_call(func_name, args, extra_read_timeout)
+			if uploads:
+				self._record_uploads(uploads, result)
+			status = "ok"
+			return result
+		finally:
+			if uploads:
+				self._release_uploads(uploads)
+			self._record_call(func_name, started, status)
+
+	def _send_call(self, func_name: str, args: dict, extra_read_timeout: float=0.0) -> dict:
+		url = self._url(func_name)
+		chat_id = args.get("chat_id")
+		args, files = self._extract_files(args)
+		args = self._encode_args(args)
 		for _ in range(10):
+			delay = self._reserve(func_name, chat_id)
+			if delay > 0:
+				time.sleep(delay)
 			try:
-				content = requests.get(url, params=args).content
-				if content == "True":
-					return True
-				result = json.loads(content)
-				if result["ok"]:
-					return result["result"]
-				else:
-					raise TelegramAPIError((
-						f"\"{func_name}\": "
-						f"{result['description']} "
-						f"[Error Code {result['error_code']}]"
-					))
+				content = self.transport.send(url, args, files, extra_read_timeout=extra_read_timeout)
+				return self._decode_result(func_name, content)
+			except TelegramFloodError as e:
+				self._pause(e, chat_id)
 			except Exception as e:
 				if isinstance(e, requests.RequestException):
 					time.sleep(1)
@@ -1052,16 +2044,30 @@ class TelegramAPI:
 					raise e
 		raise TelegramAPIError("Request failed")
 
-	def getUpdates(self) -> List[Update]:
-		args = dict()
+	def _updates_args(self, timeout: int, limit: Optional[int], allowed_updates: Optional[List[str]]) -> dict:
+		args = {"timeout": timeout, "limit": limit, "allowed_updates": allowed_updates}
 		if self.offset: args["offset"] = self.offset + 1
-		data = self.call("getUpdates", args=args)
+		return args
+
+	def _parse_updates(self, data: list) -> List[Update]:
 		results: list = [r for r in data if r["update_id"] > self.offset]
 		if results:
+			if self.journal is not None:
+				self.journal.record(results)
 			self.offset = results[-1]["update_id"]
 			return [Update(result) for result in results]
 		return list()
 
+	def getUpdates(self, timeout: int=0, limit: Optional[int]=None, allowed_updates: Optional[List[str]]=None) -> List[Update]:
+		"""a timeout > 0 makes the server hold the request open until updates arrive (long polling)"""
+		args = self._updates_args(timeout, limit, allowed_updates)
+		data = self.call("getUpdates", args=args, extra_read_timeout=timeout)
+		return self._parse_updates(data)
+
+	def close_transport(self) -> None:
+		"""closes the pooled connections (not to be confused with the Bot API method close)"""
+		self.transport.close()
+
 	def __getattr__(self, attr):
 		if attr in self.__dict__:
 			return self.__dict__[attr]
@@ -1069,6 +2075,26 @@ class TelegramAPI:
 
 	# BOT API METHODS
 
+	def set_webhook(self,
+		url: str,
+		certificate: Optional[str]=None,
+		ip_address: Optional[str]=None,
+		max_connections: Optional[int]=None,
+		allowed_updates: Optional[List[str]]=None,
+		drop_pending_updates: Optional[bool]=None,
+		secret_token: Optional[str]=None):
+		"""Use this method to specify a URL and receive incoming updates via an outgoing webhook. Whenever there is an update for the bot, we will send an HTTPS POST request to the specified URL, containing a JSON-serialized Update. If secret_token is set, it is sent in the header X-Telegram-Bot-Api-Secret-Token of every webhook request. Returns True on success."""
+		return self.call("setWebhook", {k: v for k, v in locals().items() if k != "self"})
+
+	def delete_webhook(self,
+		drop_pending_updates: Optional[bool]=None):
+		"""Use this method to remove webhook integration if you decide to switch back to getUpdates. Returns True on success."""
+		return self.call("deleteWebhook", {k: v for k, v in locals().items() if k != "self"})
+
+	def get_webhook_info(self):
+		"""Use this method to get current webhook status. Requires no parameters. On success, returns a WebhookInfo object. If the bot is using getUpdates, will return an object with the url field empty."""
+		return self.call("getWebhookInfo")
+
 	def get_me(self) -> User:
 		"""A simple method for testing your bot's authentication token. Requires no parameters. Returns basic information about the bot in form of a User object."""
 		return User(self.call("getMe"))
@@ -1121,7 +2147,7 @@ class TelegramAPI:
 
 	def send_photo(self,
 		chat_id: int or str,
-		photo: str,
+		photo: str or InputFile,
 		caption: Optional[str]=None,
 		parse_mode: Optional[str]=None,
 		caption_entities: Optional[List[MessageEntity]]=None,
@@ -1135,14 +2161,14 @@ class TelegramAPI:
 
 	def send_audio(self,
 		chat_id: int or str,
-		audio: str,
+		audio: str or InputFile,
 		caption: Optional[str]=None,
 		parse_mode: Optional[str]=None,
 		caption_entities: Optional[List[MessageEntity]]=None,
 		duration: Optional[int]=None,
 		performer: Optional[str]=None,
 		title: Optional[str]=None,
-		thumb: Optional[str]=None,
+		thumb: Optional[str or InputFile]=None,
 		disable_notification: Optional[bool]=None,
 		protect_content: Optional[bool]=None,
 		reply_to_message_id: Optional[int]=None,
@@ -1153,8 +2179,8 @@ class TelegramAPI:
 
 	def send_document(self,
 		chat_id: int or str,
-		document: str,
-		thumb: Optional[str]=None,
+		document: str or InputFile,
+		thumb: Optional[str or InputFile]=None,
 		caption: Optional[str]=None,
 		parse_mode: Optional[str]=None,
 		caption_entities: Optional[List[MessageEntity]]=None,
@@ -1169,11 +2195,11 @@ class TelegramAPI:
 
 	def send_video(self,
 		chat_id: int or str,
-		video: str,
+		video: str or InputFile,
 		duration: Optional[int]=None,
 		width: Optional[int]=None,
 		height: Optional[int]=None,
-		thumb: Optional[str]=None,
+		thumb: Optional[str or InputFile]=None,
 		caption: Optional[str]=None,
 		parse_mode: Optional[str]=None,
 		caption_entities: Optional[List[MessageEntity]]=None,
@@ -1188,11 +2214,11 @@ class TelegramAPI:
 
 	def send_animation(self,
 		chat_id: int or str,
-		animation: str,
+		animation: str or InputFile,
 		duration: Optional[int]=None,
 		width: Optional[int]=None,
 		height: Optional[int]=None,
-		thumb: Optional[str]=None,
+		thumb: Optional[str or InputFile]=None,
 		caption: Optional[str]=None,
 		parse_mode: Optional[str]=None,
 		caption_entities: Optional[List[MessageEntity]]=None,
@@ -1206,7 +2232,7 @@ class TelegramAPI:
 
 	def send_voice(self,
 		chat_id: int or str,
-		voice: str,
+		voice: str or InputFile,
 		caption: Optional[str]=None,
 		duration: Optional[int]=None,
 		disable_notification: Optional[bool]=None,
@@ -1219,10 +2245,10 @@ class TelegramAPI:
 
 	def send_video_note(self,
 		chat_id: int or str,
-		video_note: str,
+		video_note: str or InputFile,
 		duration: Optional[int]=None,
 		length: Optional[int]=None,
-		thumb: Optional[str]=None,
+		thumb: Optional[str or InputFile]=None,
 		disable_notification: Optional[bool]=None,
 		protect_content: Optional[bool]=None,
 		reply_to_message_id: Optional[int]=None,
@@ -1357,9 +2383,11 @@ class TelegramAPI:
 		return self.call("getUserProfilePhotos", {k: v for k, v in locals().items() if k != "self"})
 
 	def get_file(self,
-		file_id: str):
+		file_id: str) -> File:
 		"""Use this method to get basic info about a file and prepare it for downloading. For the moment, bots can download files of up to 20MB in size. On success, a File object is returned. The file can then be downloaded via the link https://api.telegram.org/file/bot<token>/<file_path>, where <file_path> is taken from the response. It is guaranteed that the link will be valid for at least 1 hour. When the link expires, a new one can be requested by calling getFile again."""
-		return self.call("getFile", {k: v for k, v in locals().items() if k != "self"})
+		file = File(self.call("getFile", {k: v for k, v in locals().items() if k != "self"}))
+		file._api_ref = self
+		return file
 
 	def ban_chat_member(self,
 		chat_id: int or str,
@@ -1470,7 +2498,7 @@ class TelegramAPI:
 
 	def set_chat_photo(self,
 		chat_id: int or str,
-		photo: str):
+		photo: InputFile):
 		"""Use this method to set a new profile photo for the chat. Photos can't be changed for private chats. The bot must be an administrator in the chat for this to work and must have the appropriate administrator rights. Returns True on success."""
 		return self.call("setChatPhoto", {k: v for k, v in locals().items() if k != "self"})
 
@@ -1619,3 +2647,151 @@ class TelegramAPI:
 		message_id: int) -> None:
 		"""Use this method to delete a message, including service messages, with the following limitations: - A message can only be deleted if it was sent less than 48 hours ago. - A dice message in a private chat can only be deleted if it was sent more than 24 hours ago. - Bots can delete outgoing messages in private chats, groups, and supergroups. - Bots can delete incoming messages in private chats. - Bots can't be deleted from channel chats. - Otherwise, if the bot is an administrator in a group or a supergroup and it can delete messages of up to 50 people it can do so. Returns True on success."""
 		return self.call("deleteMessage", {k: v for k, v in locals().items() if k != "self"})
+
+class AsyncHTTPTransport:
+	"""aiohttp counterpart of HTTPTransport, the session is opened on first use inside the running loop"""
+
+	def __init__(self, pool_size: int=100, connect_timeout: float=5.0, read_timeout: float=30.0):
+		if aiohttp is None:
+			raise TeleasyError("the asyncio engine requires aiohttp (pip install aiohttp)")
+		self.pool_size: int = pool_size
+		self.connect_timeout: float = connect_timeout
+		self.read_timeout: float = read_timeout
+		self.session: "aiohttp.ClientSession" = None
+
+	def _session(self) -> "aiohttp.ClientSession":
+		if self.session is None or self.session.closed:
+			connector = aiohttp.TCPConnector(limit=self.pool_size)
+			self.session = aiohttp.ClientSession(connector=connector)
+		return self.session
+
+	def _timeout(self, extra_read_timeout: float) -> "aiohttp.ClientTimeout":
+		return aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout + extra_read_timeout)
+
+	async def get(self, url: str, params: dict=None, extra_read_timeout: float=0.0) -> bytes:
+		if params:
+			# aiohttp only accepts str query values, the codec produces bytes
+			params = {k: v.decode("utf-8") if isinstance(v, bytes) else v for k, v in params.items()}
+		async with self._session().get(url, params=params, timeout=self._timeout(extra_read_timeout)) as response:
+			return await response.read()
+
+	@staticmethod
+	async def _stream(input_file: InputFile):
+		for chunk in input_file.chunks():
+			yield chunk
+
+	async def send(self, url: str, args: dict, files: dict=None, extra_read_timeout: float=0.0) -> bytes:
+		"""same request selection as HTTPTransport.send"""
+		if not files and sum(len(v) for v in args.values()) <= HTTPTransport.POST_THRESHOLD:
+			return await self.get(url, params=args, extra_read_timeout=extra_read_timeout)
+		form = aiohttp.FormData()
+		for key, value in args.items():
+			form.add_field(key, value.decode("utf-8") if isinstance(value, bytes) else value)
+		for name, input_file in (files or dict()).items():
+			form.add_field(name, self._stream(input_file), filename=input_file.filename, content_type=input_file.mime_type)
+		async with self._session().post(url, data=form, timeout=self._timeout(extra_read_timeout)) as response:
+			return await response.read()
+
+	async def download(self, url: str, write: callable, chunk_size: int=64 * 1024) -> None:
+		async with self._session().get(url, timeout=self._timeout(0.0)) as response:
+			if response.status != 200:
+				raise TelegramAPIError(f"Download failed with HTTP status {response.status}", response.status)
+			async for chunk in response.content.iter_chunked(chunk_size):
+				write(chunk)
+
+	async def close(self) -> None:
+		if self.session is not None:
+			await self.session.close()
+			self.session = None
+
+class AsyncNullTransport(NullTransport):
+
+	async def send(self, url: str, args: dict, files: dict=None, extra_read_timeout: float=0.0) -> bytes:
+		return NullTransport.send(self, url, args, files, extra_read_timeout)
+
+	async def download(self, url: str, write: callable, chunk_size: int=64 * 1024) -> None:
+		pass
+
+	async def close(self) -> None:
+		pass
+
+class AsyncTelegramAPI(TelegramAPI):
+	"""same methods as TelegramAPI, but every Bot API method returns an awaitable"""
+
+	transport_type = AsyncHTTPTransport
+
+	def __init__(self, token: str, pool_size: int=100, connect_timeout: float=5.0, read_timeout: float=30.0,
+			base_url: str=TelegramAPI.DEFAULT_BASE_URL):
+		super().__init__(token, pool_size, connect_timeout, read_timeout, base_url)
+
+	def set_max_downloads(self, max_downloads: int) -> None:
+		self.download_limit = asyncio.Semaphore(max_downloads)
+
+	async def call(self, func_name: str, args=dict(), extra_read_timeout: float=0.0) -> dict:
+		started = time.perf_counter()
+		status = "error"
+		# waiting for a concurrent upload of the same file would block the event loop
+		args, uploads = self._reuse_uploads(args, wait=False)
+		try:
+			result = await self._send_call(func_name, args, extra_read_timeout)
+			if uploads:
+				self._record_uploads(uploads, result)
+			status = "ok"
+			return result
+		finally:
+			if uploads:
+				self._release_uploads(uploads)
+			self._record_call(func_name, started, status)
+
+	async def _send_call(self, func_name: str, args: dict, extra_read_timeout: float=0.0) -> dict:
+		url = self._url(func_name)
+		chat_id = args.get("chat_id")
+		args, files = self._extract_files(args)
+		args = self._encode_args(args)
+		for _ in range(10):
+			delay = self._reserve(func_name, chat_id)
+			if delay > 0:
+				await asyncio.sleep(delay)
+			try:
+				content = await self.transport.send(url, args, files, extra_read_timeout=extra_read_timeout)
+				return self._decode_result(func_name, content)
+			except TelegramFloodError as e:
+				if self.rate_limiter is None:
+					await asyncio.sleep(e.retry_after)
+				else:
+					self.rate_limiter.pause(e.retry_after, chat_id)
+			except (aiohttp.ClientError, asyncio.TimeoutError):
+				await asyncio.sleep(1)
+		raise TelegramAPIError("Request failed")
+
+	async def getUpdates(self, timeout: int=0, limit: Optional[int]=None, allowed_updates: Optional[List[str]]=None) -> List[Update]:
+		args = self._updates_args(timeout, limit, allowed_updates)
+		data = await self.call("getUpdates", args=args, extra_read_timeout=timeout)
+		return self._parse_updates(data)
+
+	async def close_transport(self) -> None:
+		await self.transport.close()
+
+	async def get_me(self) -> User:
+		return User(await self.call("getMe"))
+
+	async def send_message(self, chat_id: int or str, text: str, **kwargs) -> Message:
+		return Message(await self.call("sendMessage", {"chat_id": chat_id, "text": text, **kwargs}))
+
+	async def get_file(self, file_id: str) -> File:
+		file = File(await self.call("getFile", {"file_id": file_id}))
+		file._api_ref = self
+		return file
+
+	async def download_file(self, file: str or ApiObject, dest: any, chunk_size: int=64 * 1024) -> any:
+		cached = self._cached_file(file)
+		if cached is None and self._needs_file_info(file):
+			file = await self.get_file(file if isinstance(file, str) else file.file_id)
+			cached = self._cached_file(file)
+		if cached is not None:
+			await asyncio.to_thread(DownloadSink.copy, cached, dest, chunk_size)
+			return dest
+		async with self.download_limit:
+			with DownloadSink(dest, self.file_cache, file.file_unique_id) as sink:
+				await self.transport.download(self._file_url(file.file_path), sink.write, chunk_size)
+		return dest